@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+import argparse
+import os
+import sys
+
+from reportcards import sources
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Assemble the data the report cards are rendered from')
+    parser.add_argument('trackvalue', metavar='TRACKVALUE', type=str,
+                        help='The trackvalue data (trackvalue.csv)')
+    parser.add_argument('--crossreg', metavar='FILE', type=str,
+                        help='The checked EUCTR cross-registrations (crossreg-euctr-data.csv)')
+    parser.add_argument('--oa-checks', metavar='FILE', type=str,
+                        help='The manual open access checks (oa-checks.csv)')
+    parser.add_argument('--corrections', metavar='FILE', type=str,
+                        help='Manual corrections, one (id, column, value) row per corrected value')
+    parser.add_argument('--out', metavar='FILE', type=str, required=True,
+                        help='Where to write the assembled data (e.g. trackvalue-checked.csv)')
+    parser.add_argument('--cache-dir', metavar='DIR', type=str,
+                        help='Where to keep the join of trackvalue and the cross-registrations between runs, '
+                             'so that changes to the OA checks or corrections alone are applied quickly')
+
+    args = parser.parse_args()
+
+    try:
+        data = sources.assemble(args.trackvalue, args.crossreg, args.oa_checks,
+                                args.corrections, args.cache_dir)
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    # Tell which trials changed, i.e. which cards will be rendered again
+    if os.path.exists(args.out):
+        changed = sources.changed_trials(sources.read_source(args.out), data)
+        print(f"{len(changed)} of {len(data)} trials changed", file=sys.stderr)
+        for trial in changed:
+            print(f"  {trial}", file=sys.stderr)
+    else:
+        print(f"{len(data)} trials", file=sys.stderr)
+
+    sources.write_csv(data, args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from reportcards import Renderer, converters, packaging, schema
+from reportcards.specs import merged
+from reportcards.timing import StageTimer
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE = os.path.join(HERE, "report-card-merged.svg")
+INFOSHEET = os.path.join(HERE, "infosheet.pdf")
+HISTORY = os.path.join(HERE, "benchmark-history.json")
+
+# The converters of the real tools, and the stub (see StubConverter)
+BENCHMARK_CONVERTERS = dict(converters.CONVERTERS, stub=converters.StubConverter)
+
+WORDS = ("trial study effect patients randomized controlled therapy stroke "
+         "stimulation outcome cognitive treatment pilot safety efficacy").split()
+
+
+# Function to collect, per decision column, the values its branches test for
+def condition_domains(decision):
+    domains = {}
+    for _, leaves in decision.modules:
+        for conditions, _ in leaves:
+            for column, condition in conditions:
+                domains.setdefault(column, [])
+                if not any(condition is v or condition == v for v in domains[column]):
+                    domains[column].append(condition)
+    return domains
+
+
+# Function to write a synthetic cohort of `size` trials with the columns of
+# the schema. The first rows walk every leaf of every module, the rest pick
+# each decision column at random from the values the tree tests for.
+def synthesize_cohort(path, size, decision, seed=0):
+    rng = random.Random(seed)
+    domains = condition_domains(decision)
+    leaves = [leaf for _, module_leaves in decision.modules for leaf in module_leaves]
+
+    rows = []
+    for i in range(size):
+        registry = "DRKS" if i % 8 == 0 else "ClinicalTrials.gov"
+        trn = f"DRKS{i:08d}" if registry == "DRKS" else f"NCT{i:08d}"
+        start = datetime.date(2008, 1, 1) + datetime.timedelta(days=rng.randrange(3650))
+        completion = start + datetime.timedelta(days=rng.randrange(60, 2000))
+        row = {
+            "id": trn,
+            "registry": registry,
+            "title": " ".join(rng.choice(WORDS) for _ in range(rng.randrange(3, 25))).capitalize(),
+            "url": f"https://doi.org/10.1000/{i}" if rng.random() < 0.9 else np.nan,
+            "citation": (f"Doe et al. ({start.year}) " + " ".join(rng.choice(WORDS) for _ in range(8))
+                         if rng.random() < 0.8 else np.nan),
+            "doi": f"10.1000/{i}",
+            "pub_title": " ".join(rng.choice(WORDS) for _ in range(rng.randrange(3, 15))).capitalize(),
+            "trn_eudract": f"{start.year}-{i % 1000000:06d}-{i % 100:02d}",
+            "days_reg_to_start": rng.randrange(-1000, 1000),
+            "start_date": start.isoformat(),
+            "completion_date": completion.isoformat(),
+        }
+        for column, values in domains.items():
+            row[column] = rng.choice(values)
+        if i < len(leaves):
+            conditions, _ = leaves[i]
+            row.update(dict(conditions))
+        rows.append(row)
+
+    data = pd.DataFrame(rows)
+    # Write flags the way R does (TRUE/FALSE/NA)
+    for column in domains:
+        data[column] = data[column].map({True: "TRUE", False: "FALSE"})
+    data.to_csv(path, index=False, na_rep="NA")
+
+
+# Function to group trials into synthetic trialists of 1-21 trials each
+def synthesize_packages(trials, seed=0):
+    rng = random.Random(seed)
+    packages = []
+    i = 0
+    while i < len(trials):
+        n = rng.randrange(1, 22)
+        packages.append((f"trialist-{len(packages):05d}", trials[i:i + n]))
+        i += n
+    return packages
+
+
+# Function to run the pipeline stage by stage on one cohort and time it
+def run(size, tmp, converter, seed=0):
+    timer = StageTimer()
+    csv = os.path.join(tmp, f"cohort-{size}.csv")
+    synthesize_cohort(csv, size, merged.SPEC.decision, seed)
+
+    with timer.stage("load"):
+        data = schema.load_trials(csv)
+    with timer.stage("assign"):
+        assignments = merged.SPEC.decision.assign(data)
+
+    renderer = Renderer(merged.SPEC, TEMPLATE)
+    pdfs = {}
+    failures = 0
+    for row, assignment in zip(data.to_dict("records"), assignments.to_dict("records")):
+        try:
+            svg = renderer.render(row, assignment, timer=timer)
+        except Exception:
+            failures += 1
+            continue
+        with timer.stage("convert"):
+            pdfs[row['id']] = converter.convert_to_bytes(svg)
+
+    letters = os.path.join(tmp, "letters")
+    outdir = os.path.join(tmp, "packages")
+    os.makedirs(letters, exist_ok=True)
+    os.makedirs(outdir, exist_ok=True)
+    packages = synthesize_packages(list(pdfs), seed)
+    for name, _ in packages:
+        with open(os.path.join(letters, f"{name}.pdf"), "wb") as f:
+            f.write(converters.blank_pdf())
+
+    with timer.stage("package"):
+        assembler = packaging.PackageAssembler(packages, letters, INFOSHEET, outdir)
+        for trial, pdf in pdfs.items():
+            assembler.add(trial, pdf)
+        assembler.finish()
+
+    return {"size": size, "failures": failures, "packages": len(packages),
+            "stages": timer.as_dict()}
+
+
+# Function to find the result of the last recorded run with the same size
+def previous_result(history, size):
+    for entry in reversed(history):
+        for result in entry["results"]:
+            if result["size"] == size:
+                return result
+    return None
+
+
+def print_result(result, previous):
+    print(f"{result['size']} trials ({result['failures']} failed, {result['packages']} packages)")
+    for name, stage in result["stages"].items():
+        per_call = stage["seconds"] / max(stage["calls"], 1) * 1000
+        line = f"  {name:<10} {stage['seconds']:9.3f}s  {per_call:9.3f}ms/call"
+        if previous and name in previous["stages"] and previous["stages"][name]["seconds"]:
+            change = stage["seconds"] / previous["stages"][name]["seconds"] - 1
+            line += f"  {change:+.1%} vs last run"
+        print(line)
+
+
+# Function to build a converter by name (see BENCHMARK_CONVERTERS)
+def get_converter(name, inkscape=None):
+    if name == "stub":
+        return converters.StubConverter()
+    return converters.get_converter(name, inkscape)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the report card generator on synthetic cohorts')
+    parser.add_argument('--sizes', metavar='N', type=int, nargs='+', default=[1000],
+                        help='Cohort sizes to run (default: 1000)')
+    parser.add_argument('--converter', choices=sorted(BENCHMARK_CONVERTERS), default="stub",
+                        help='SVG to PDF converter (default: stub, which needs no Inkscape)')
+    parser.add_argument('--inkscape', metavar='PATH', type=str,
+                        help='The Inkscape binary')
+    parser.add_argument('--history', metavar='FILE', type=str, default=HISTORY,
+                        help='JSON file the results are appended to (default: benchmark-history.json '
+                             'next to this script, ignored by git)')
+    parser.add_argument('--seed', metavar='N', type=int, default=0,
+                        help='Seed for the synthetic cohorts (default: 0)')
+
+    args = parser.parse_args()
+
+    try:
+        with open(args.history) as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        history = []
+
+    entry = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "converter": args.converter,
+        "results": [],
+    }
+
+    with get_converter(args.converter, args.inkscape) as converter:
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory() as tmp:
+                start = time.perf_counter()
+                result = run(size, tmp, converter, args.seed)
+                result["total_seconds"] = time.perf_counter() - start
+            print_result(result, previous_result(history, size))
+            entry["results"].append(result)
+
+    history.append(entry)
+    with open(args.history, "w") as f:
+        json.dump(history, f, indent=1)
+    print(f"Results appended to {args.history}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from reportcards import converters
+
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "..", "example", "NCT12345678.svg")
+
+
+# Function to read page count and page size with pdfinfo (poppler)
+def pdf_info(pdf):
+    out = subprocess.run(["pdfinfo", pdf], check=True, capture_output=True, text=True).stdout
+    info = {}
+    for line in out.splitlines():
+        key, _, value = line.partition(":")
+        info[key.strip()] = value.strip()
+    return info.get("Pages"), info.get("Page size")
+
+
+# Function to rasterize the first page to a greyscale bitmap with pdftoppm
+def rasterize(pdf, resolution):
+    out = subprocess.run(["pdftoppm", "-r", str(resolution), "-gray", "-singlefile", pdf],
+                         check=True, capture_output=True).stdout
+    # Binary PGM: "P5 <width> <height> <maxval>" followed by one byte per pixel
+    fields = []
+    pos = 0
+    while len(fields) < 4:
+        while out[pos:pos + 1].isspace():
+            pos += 1
+        start = pos
+        while not out[pos:pos + 1].isspace():
+            pos += 1
+        fields.append(out[start:pos])
+    width, height = int(fields[1]), int(fields[2])
+    return width, height, out[pos + 1:pos + 1 + width * height]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the PDF output of two SVG to PDF converters')
+    parser.add_argument('svg', metavar='SVG', type=str, nargs='?', default=EXAMPLE,
+                        help='The SVG to convert (default: the example report card)')
+    parser.add_argument('--reference', choices=sorted(converters.CONVERTERS),
+                        default="inkscape", help='The converter to compare against (default: inkscape)')
+    parser.add_argument('--candidate', choices=sorted(converters.CONVERTERS),
+                        default="cairosvg", help='The converter to check (default: cairosvg)')
+    parser.add_argument('--inkscape', metavar='PATH', type=str,
+                        help='The Inkscape binary')
+    parser.add_argument('--resolution', metavar='DPI', type=int, default=72,
+                        help='Resolution to rasterize the pages at (default: 72)')
+    parser.add_argument('--tolerance', metavar='FRACTION', type=float, default=0.01,
+                        help='Largest accepted fraction of differing pixels (default: 0.01)')
+    parser.add_argument('--outdir', metavar='DIR', type=str,
+                        help='Keep the PDFs in this directory (default: discard them)')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        outdir = args.outdir or tmp
+        os.makedirs(outdir, exist_ok=True)
+
+        pdfs = {}
+        for name in (args.reference, args.candidate):
+            pdfs[name] = os.path.join(outdir, f"{name}.pdf")
+            with converters.get_converter(name, args.inkscape) as converter:
+                converter.convert(args.svg, pdfs[name])
+
+        ref_info = pdf_info(pdfs[args.reference])
+        cand_info = pdf_info(pdfs[args.candidate])
+        print(f"{args.reference}: {ref_info[0]} page(s), {ref_info[1]}")
+        print(f"{args.candidate}: {cand_info[0]} page(s), {cand_info[1]}")
+        if ref_info != cand_info:
+            print("FAIL: page count or page size differ")
+            sys.exit(1)
+
+        ref_w, ref_h, ref_px = rasterize(pdfs[args.reference], args.resolution)
+        cand_w, cand_h, cand_px = rasterize(pdfs[args.candidate], args.resolution)
+        if (ref_w, ref_h) != (cand_w, cand_h):
+            print(f"FAIL: bitmap sizes differ ({ref_w}x{ref_h} vs {cand_w}x{cand_h})")
+            sys.exit(1)
+
+        # Count pixels whose grey level differs noticeably (anti-aliasing
+        # alone stays well below the threshold)
+        differing = sum(1 for a, b in zip(ref_px, cand_px) if abs(a - b) > 32)
+        fraction = differing / len(ref_px)
+        print(f"{differing} of {len(ref_px)} pixels differ ({fraction:.2%})")
+
+        if fraction > args.tolerance:
+            print(f"FAIL: more than {args.tolerance:.2%} of the pixels differ")
+            sys.exit(1)
+        print("OK")
+
+
+if __name__ == "__main__":
+    main()
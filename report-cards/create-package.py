@@ -1,8 +1,80 @@
 import argparse
-import subprocess
 import os
+import shutil
+import sys
 import pandas as pd
 
+from reportcards import manifest, packaging, parallel, sharding
+from reportcards.scheduler import SubprocessScheduler, completed, failed, then
+
+
+# State of a packaging worker, set up once per process by init_worker
+_worker = {}
+
+
+def init_worker(args):
+    _worker["letters_dir"] = args.letters_dir
+    _worker["reports_dir"] = args.reports_dir
+    _worker["infosheet"] = args.infosheet
+    _worker["outdir"] = args.outdir
+    _worker["engine"] = args.engine
+    _worker["optimize"] = args.optimize
+    _worker["qpdf"] = args.qpdf if args.object_streams else None
+    # Parsed PDFs are kept per worker and shared by all packages it builds
+    _worker["cache"] = packaging.PdfCache()
+    _worker["scheduler"] = None
+    if args.engine == "pdfunite" or args.object_streams:
+        _worker["scheduler"] = SubprocessScheduler(args.subprocesses, args.timeout, args.retries)
+
+
+# Function to build the package of one trialist; returns a Future, as
+# pdfunite runs in the background
+def create_package(row):
+    name = row['name_for_file']
+    merged = os.path.join(_worker["outdir"], f"{name}.pdf")
+    sources = packaging.package_sources(row, _worker["letters_dir"],
+                                        _worker["reports_dir"], _worker["infosheet"])
+
+    if _worker["engine"] == "pdfunite":
+        tmp = merged + ".tmp"
+        return then(_worker["scheduler"].submit(["pdfunite"] + sources + [tmp], output=tmp),
+                    os.replace, tmp, merged)
+    future = completed(packaging.merge, sources, merged, _worker["cache"], _worker["optimize"])
+    if _worker["qpdf"] and future.exception() is None:
+        future = compact_package(merged)
+    return future
+
+
+# Function to rewrite a package with qpdf, packing its objects into
+# compressed object streams (which pypdf cannot write); returns a Future
+def compact_package(path):
+    tmp = path + ".qpdf.tmp"
+    cmd = [_worker["qpdf"], "--object-streams=generate", "--compress-streams=y",
+           "--recompress-flate", "--compression-level=9", "--warning-exit-0", path, tmp]
+    return then(_worker["scheduler"].submit(cmd, output=tmp), os.replace, tmp, path)
+
+
+# Function to build the packages of a chunk of trialists, recording
+# failures instead of aborting the whole batch
+def package_chunk(chunk):
+    futures = []
+    for row in chunk.to_dict("records"):
+        try:
+            future = create_package(row)
+        except Exception as e:
+            future = failed(e)
+        futures.append((row['name_for_file'], future))
+
+    results = []
+    for name, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            results.append((name, f"{type(e).__name__}: {e}"))
+        else:
+            results.append((name, None))
+    return results
+
 
 def main():
     parser = argparse.ArgumentParser(description='Create email package')
@@ -17,28 +89,88 @@ def main():
     parser.add_argument('--outdir', metavar='DIR', type=str,
                         default=os.getcwd(), dest="outdir",
                         help='Where to store the final attachments (default: current work dir)')
+    parser.add_argument('--infosheet', metavar='FILE', type=str,
+                        default="infosheet.pdf",
+                        help='The info sheet appended to every package (default: infosheet.pdf)')
+    parser.add_argument('--jobs', metavar='N', type=int, default=1,
+                        help='Number of worker processes (default: 1)')
+    parser.add_argument('--engine', choices=["pypdf", "pdfunite"], default="pypdf",
+                        help='Merge in process with pypdf or with pdfunite (default: pypdf)')
+    parser.add_argument('--shard', metavar='I/N', type=sharding.parse_shard,
+                        help='Only build the packages of the I-th of N slices of the trialists, '
+                             'so that N machines can share the work')
+    parser.add_argument('--optimize', action="store_true", default=False,
+                        help='With pypdf, store every resource the pages have in common (fonts as well as '
+                             'images) once and compress uncompressed page contents')
+    parser.add_argument('--object-streams', action="store_true", default=False,
+                        help='With pypdf, rewrite every package with qpdf into compressed object streams')
+    parser.add_argument('--qpdf', metavar='PATH', type=str, default="qpdf",
+                        help='The qpdf binary (default: qpdf from the PATH)')
+    parser.add_argument('--mail-limit', metavar='MB', type=float, default=10,
+                        help='Size limit of the mail servers; packages larger than this once attached to an '
+                             'email (base64 encoded) are listed at the end (default: 10)')
+    parser.add_argument('--size-report', metavar='FILE', type=str,
+                        help='Write the size of every package to this .csv file')
+    parser.add_argument('--subprocesses', metavar='N', type=int, default=1,
+                        help='With pdfunite or qpdf, commands each worker runs at the same time (default: 1)')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=120,
+                        help='With pdfunite or qpdf, kill a command that takes longer than this (default: 120)')
+    parser.add_argument('--retries', metavar='N', type=int, default=1,
+                        help='With pdfunite or qpdf, times a failed or killed command is retried (default: 1)')
 
     args = parser.parse_args()
 
+    if args.engine == "pdfunite" and (args.optimize or args.object_streams):
+        parser.error("--optimize and --object-streams need the pypdf engine")
+    if args.object_streams:
+        qpdf = shutil.which(args.qpdf)
+        if qpdf is None:
+            parser.error(f"qpdf not found at {args.qpdf}; --object-streams needs it")
+        args.qpdf = qpdf
+
     os.makedirs(args.outdir, exist_ok=True)
 
     # Read dataset with email parameters
-    data = pd.read_csv(args.data)
-
-    # Iterate over each contact and select the correct files to merge
-    for _, row in data.iterrows():
-        name = row['name_for_file']
-        letter_to_merge = os.path.join(args.letters_dir, f"{name}.pdf")
-        merged = os.path.join(args.outdir, f"{name}.pdf")
-        rc = row['ids']
-        rc_split = rc.split(";")
-        trials = []
-        for trial in rc_split:
-            trial = trial.strip()
-            reports_to_merge = os.path.join(args.reports_dir, f"{trial}.pdf")
-            trials.append(reports_to_merge)
-
-        subprocess.run(["pdfunite", letter_to_merge] + trials + ["infosheet.pdf", merged], check=True)
+    data = sharding.select(pd.read_csv(args.data), 'name_for_file', args.shard)
+
+    # Check that every letter and report card is there before merging anything
+    sources = []
+    for row in data.to_dict("records"):
+        sources.extend(packaging.package_sources(row, args.letters_dir,
+                                                 args.reports_dir, args.infosheet))
+    missing = packaging.find_missing(sources)
+    if missing:
+        print(f"{len(missing)} files are missing:", file=sys.stderr)
+        for path in missing:
+            print(f"  {path}", file=sys.stderr)
+        sys.exit(1)
+
+    # Iterate over each contact and merge the correct files
+    chunks = parallel.split_rows(data, args.jobs * 4)
+    results = parallel.run_chunks(package_chunk, chunks, jobs=args.jobs,
+                                  initializer=init_worker, initargs=(args,))
+    failures, count = parallel.report_progress(results, len(data))
+    parallel.print_summary(failures, count, what="packages created")
+
+    failed_names = {name for name, _ in failures}
+    if args.shard:
+        # Every package of the shard, whether built or failed (see merge-shards.py)
+        keys = {row['name_for_file']: manifest.card_key(packaging.package_sources(
+                    row, args.letters_dir, args.reports_dir, args.infosheet))
+                for row in data.to_dict("records")}
+        inputs = {"data": manifest.file_digest(args.data),
+                  "infosheet": manifest.file_digest(args.infosheet),
+                  "engine": args.engine, "optimize": args.optimize,
+                  "object_streams": args.object_streams}
+        sharding.save_packages(args.outdir, args.shard, keys,
+                               [name for name in keys if name not in failed_names], inputs)
+    limit = int(args.mail_limit * 1024 ** 2)
+    sizes = packaging.size_report([name for name in data['name_for_file'] if name not in failed_names],
+                                  args.outdir, limit, args.size_report)
+    packaging.print_size_report(sizes, limit)
+
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,592 +1,634 @@
 #!/usr/bin/python3
 import argparse
-import copy
+import atexit
 import fnmatch
 import os
-import subprocess
+import sys
+import time
 
-from lxml import etree
 import pandas as pd
-import numpy as np
-
-
-# Function to add hyperlinks
-def linkify(node, target):
-    link = etree.Element("a")
-    link.attrib["{http://www.w3.org/1999/xlink}href"] = target
-    link.attrib["target"] = "_blank"
-
-    parent = node.getparent()
-    # Insert hyperlink anchors at the right level (where node comes from)
-    parent.insert(parent.index(node), link)
-    parent.remove(node)
-
-    # Insert content of link
-    link.insert(0, node)
-
-
-def get_element(root, id_name, section_type="g"):
-    results = root.xpath(f"//svg:{section_type}[@id = '{id_name}']", namespaces={"svg": "http://www.w3.org/2000/svg"})
-
-    if not results:
-        return None
-
-    if section_type == "g":
-        node = results[0].getchildren()[0]
-    else:
-        node = results[0]
-
-    return node
-
-
-# Function to replace text
-def replace(root, section_type, id_name, text=None, target=None):
-    node = get_element(root, id_name, section_type)
-    if node is None:
-        print(f"WARNING: {id_name} field does not exist")
-        return
-
-    if text is not None:
-        node.text = str(text)
-
-    if not target:
-        return
-
-    linkify(node, target)
-
-
-# Function to select and delete layers
-def remove_layers(root, layers_to_exclude):
-    for layer_to_exclude in layers_to_exclude:
-        layer = root.xpath(f"//svg:g[@id = '{layer_to_exclude}']", namespaces={"svg": "http://www.w3.org/2000/svg"})
-
-        if not layer:
-            raise Exception(f"{layer_to_exclude} field does not exist")
-
-        node = layer[0]
-
-        parent = node.getparent()
-        parent.remove(node)
-
-
-# Function to build layer names in a specific module (e.g., registration)
-def gen_layer(desc):
-    result = []
-    name = desc["name"]
-    number = desc["number"]
-    for i in range(number):
-        result.append(f"{name}_layer_{i+1}")
-    if desc["na"]:
-        result.append(f"{name}_layer_na")
-    return set(result)
-
-
-# Function to combine all layers across all modules
-def get_all_layers(layers):
-    all_layers = set()
-    for layer in layers:
-        all_layers.update(gen_layer(layer))
-    return all_layers
-
-
-# Function to build the link to the registry (CT.gov or DRKS)
-def gen_registry_url(row):
-    registry = row['registry']
-    if registry == "ClinicalTrials.gov":
-        url = "https://clinicaltrials.gov/ct2/show/" + row['id']
-    elif registry == "DRKS":
-        url = "https://www.drks.de/drks_web/navigate.do?navigationId=trial.HTML&TRIAL_ID=" + row['id']
-    else:
-        raise RuntimeError(f"Unknown registry {registry}")
-    return url
-
-
-def url_for_publication(row):
-    url = row["url"]
-
-    if not isinstance(url, str):
-        if np.isnan(url):
-            url = ""
-    return url
-
-
-def url_for_improve_sumres(row):
-    registry = row['registry']
-    if registry == "ClinicalTrials.gov":
-        url = "https://clinicaltrials.gov/ct2/manage-recs/how-report"
-    elif registry == "DRKS":
-        url = "https://www.drks.de/drks_web/navigate.do?navigationId=edit&messageDE=Studien%20registrieren&messageEN=Register%20trials"
-    else:
-        raise RuntimeError(f"Unknown registry {registry}")
-    return url
-
+from lxml import etree
 
-def url_for_improve_link(row):
-    registry = row['registry']
-    if registry == "ClinicalTrials.gov":
-        url = "https://prsinfo.clinicaltrials.gov/tutorial/content/index.html#/lessons/GE_igGejMjFu9WtErAxXw9-qdeUggVBX"
-    elif registry == "DRKS":
-        url = "https://www.drks.de/drks_web/navigate.do?navigationId=edit&messageDE=Studien%20registrieren&messageEN=Register%20trials"
+from reportcards import (DecisionTable, Renderer, converters, journal, manifest, packaging, parallel, profiling,
+                         schema, sharding, sources)
+from reportcards.assets import AssetStore
+from reportcards.scheduler import SubprocessScheduler, completed, failed, then
+from reportcards.specs import SPECS
+from reportcards.store import PdfStore
+from reportcards.template import SVG_FORMATS, CompiledTemplate, serialize, write_svg
+from reportcards.timing import NULL_TIMER
+
+
+# The kind of card a template is rendered as unless given (see
+# parse_templates): the decision tree (TABLE) and the layers of every
+# module, see reportcards/specs/merged.py
+DEFAULT_SPEC = "merged"
+
+
+# Function to render the report card of one trial (SVG and optionally PDF)
+# Returns a Future for the conversion, which may still be running.
+def render_trial(renderer, row, assignment, outdir, converter=None, keep_svg=False,
+                 timer=NULL_TIMER, svg_format="pretty", scheduler=None):
+    name = row['id']
+    outfile = os.path.join(outdir, name + SVG_FORMATS[svg_format])
+
+    card = renderer.fill(row, assignment, timer)
+
+    # In-process converters work from memory, so the SVG only goes to
+    # disk when it is the output or when asked for
+    if converter is None or keep_svg or not converter.in_process:
+        with timer.stage("write"):
+            write_svg(card.root, outfile, svg_format)
+
+    # optionally skip the pdf if requested
+    if converter is None:
+        return completed(lambda: None)
+
+    outpdf = os.path.join(outdir, f"{name}.pdf")
+    # Converted to a partial file that is renamed into place once complete,
+    # so that an interrupted run never leaves a truncated PDF behind
+    partial = journal.partial_path(outpdf)
+
+    # Convert modified SVG to PDF with inkscape (open source) or in process
+    if converter.in_process:
+        with timer.stage("serialize"):
+            out = serialize(card.root, svg_format)
+        with timer.stage("convert"):
+            future = completed(converter.convert_bytes, out, partial)
     else:
-        raise RuntimeError(f"Unknown registry {registry}")
-    return url
-
-
-def url_for_library(_row):
-    url = "https://bibliothek.charite.de/en/publishing/open_access/the_green_route_to_open_access/"
-    return url
+        # Conversions may run in the background; they are timed from being
+        # submitted until they are done (waiting for a free slot included)
+        start = time.perf_counter()
+        future = converter.submit(outfile, partial, scheduler)
+        future.add_done_callback(lambda _: timer.add("convert", time.perf_counter() - start))
+    return then(future, os.replace, partial, outpdf)
+
+
+# Function to list the files rendering a card produces (see render_trial)
+def output_files(outdir, name, converter_name, keep_svg, svg_format="pretty"):
+    files = []
+    if converter_name is None or keep_svg or not converters.CONVERTERS[converter_name].in_process:
+        files.append(os.path.join(outdir, name + SVG_FORMATS[svg_format]))
+    if converter_name is not None:
+        files.append(os.path.join(outdir, f"{name}.pdf"))
+    return files
+
+
+# Function to label the templates given on the command line, as
+# LABEL=SPEC:PATH, where both LABEL= (the file name by default) and SPEC:
+# (a kind of card in specs.SPECS, merged by default) may be left out.
+# Returns (label, spec, path, subdir) for each. With several templates,
+# e.g. one per language or the classic card next to the merged one, the
+# cards of each go into a subdirectory named by its label.
+def parse_templates(arguments):
+    templates = []
+    for argument in arguments:
+        label, sep, path = argument.partition("=")
+        if not sep:
+            label, path = None, argument
+        spec, sep, rest = path.partition(":")
+        if sep and spec in SPECS:
+            path = rest
+        else:
+            spec = DEFAULT_SPEC
+        if label is None:
+            label = os.path.splitext(os.path.basename(path))[0]
+        templates.append((label, spec, path, label if len(arguments) > 1 else ""))
+    return templates
+
+
+# Function to check that every template has the layers and fields of its
+# kind of card; returns a message for each template that does not
+def check_templates(templates, cache_dir=None):
+    problems = []
+    for label, spec, path, _ in templates:
+        try:
+            missing = SPECS[spec].missing(CompiledTemplate.load(path, cache_dir=cache_dir))
+        except (OSError, etree.XMLSyntaxError) as e:
+            problems.append(f"cannot read template {label} ({path}): {e}")
+            continue
+        if missing:
+            shown = ", ".join(missing[:5]) + (", ..." if len(missing) > 5 else "")
+            problems.append(f"template {label} ({path}) is not a {spec} card, "
+                            f"it has no {shown}")
+    return problems
+
+
+# Function to name a card in the manifest and the progress: the TRN, under
+# the subdirectory of its template when there are several
+def card_name(subdir, name):
+    return f"{subdir}/{name}" if subdir else name
+
+
+# Function to key a card on everything its output depends on: the template,
+# the rendering code, the converter, the SVG format and the trial's values
+# used on the card
+def get_card_key(template_digest, code, converter_name, svg_format, row, spec, assignment):
+    return manifest.card_key(
+        template_digest, code, converter_name, svg_format, spec,
+        [row['id'], row['title'], row['registry']],
+        [assignment[module] for module, _ in SPECS[spec].decision.modules],
+        assignment["fields"])
+
+
+# Function to note each rendered card in the manifest as results come in
+# (the workers have already journaled them, with the checksums of their files)
+def record_results(results, built, keys, outdir, converter_name, keep_svg, svg_format):
+    for name, error, checksums in results:
+        if error is None:
+            built.record(name, keys[name],
+                         output_files(outdir, name, converter_name, keep_svg, svg_format), checksums)
+        else:
+            built.forget(name)
+        yield name, error
+
+
+# Function to filter a batch of trials and select the layers and fields of
+# every trial in it in a single pass per kind of card; returns the data and
+# the assignments by spec
+def assign_batch(data, args, first=True):
+    if args.filter:
+        data = data[[fnmatch.fnmatch(name, args.filter) for name in data['id']]]
+
+    specs = sorted({spec for _, spec, _, _ in args.templates})
+    assignments = {spec: SPECS[spec].decision.assign(data) for spec in specs}
+
+    if args.assignments:
+        for spec in specs:
+            # With several kinds of card, one file each (e.g. assignments.classic.csv)
+            path = args.assignments
+            if len(specs) > 1:
+                root, extension = os.path.splitext(path)
+                path = f"{root}.{spec}{extension}"
+            DecisionTable.to_csv(assignments[spec], data['id'], path, append=not first)
+
+    return data, assignments
+
+
+# Function to turn batches of trials into chunks of work for the renderer.
+# With a manifest (`built`), cards whose inputs did not change since they
+# were last rendered into the output directory are skipped (unless --force).
+def plan_work(batches, args, converter_name, built=None, keys=None, stats=None):
+    digests = {path: manifest.file_digest(path) for _, _, path, _ in args.templates}
+    if args.assets:
+        # Cards refer to the images by their path in the asset store
+        digests = {path: manifest.card_key(digest, os.path.abspath(args.assets))
+                   for path, digest in digests.items()}
+    code = manifest.code_digest(__file__)
+
+    for i, data in enumerate(batches):
+        data, assignments = assign_batch(data, args, first=i == 0)
+
+        if built is not None:
+            # A trial is rendered again (with all templates) when any of
+            # its cards is out of date
+            todo = []
+            records = {spec: a.to_dict("records") for spec, a in assignments.items()}
+            for i, row in enumerate(data.to_dict("records")):
+                stale = args.force
+                for _, spec, path, subdir in args.templates:
+                    name = card_name(subdir, row['id'])
+                    keys[name] = get_card_key(digests[path], code, converter_name, args.svg_format,
+                                              row, spec, records[spec][i])
+                    files = output_files(args.outdir, name, converter_name, args.keep_svg,
+                                         args.svg_format)
+                    stale = stale or not built.is_current(name, keys[name], files, args.verify)
+                todo.append(stale)
+
+            stats["skipped"] += (len(todo) - sum(todo)) * len(args.templates)
+            data = data[todo]
+
+        if data.empty:
+            continue
 
+        # Hand each worker several chunks so that uneven trials balance out;
+        # the templates are parsed and indexed once per worker. The keys of
+        # the cards go along for the journal.
+        for chunk in parallel.split_rows(data, args.jobs * 4):
+            chunk_keys = None
+            if keys is not None:
+                chunk_keys = {card_name(subdir, trial): keys[card_name(subdir, trial)]
+                              for trial in chunk['id'] for _, _, _, subdir in args.templates}
+            yield chunk, {spec: a.loc[chunk.index] for spec, a in assignments.items()}, chunk_keys
+
+
+# Function to read in the data with trial-specific characteristics (only
+# the columns the card uses, with declared types), as a whole or streamed
+# in bounded batches. With any of the checked sources, the data is the raw
+# trackvalue table and they are joined in here (see sources.assemble).
+def load_batches(args):
+    if args.crossreg or args.oa_checks or args.corrections:
+        data = schema.typed(sources.assemble(args.data, args.crossreg, args.oa_checks,
+                                             args.corrections, args.cache_dir))
+        if not args.chunksize:
+            return [data]
+        return (data[start:start + args.chunksize] for start in range(0, len(data), args.chunksize))
+
+    if args.chunksize:
+        return schema.load_trials(args.data, chunksize=args.chunksize)
+    return [schema.load_trials(args.data, cache_dir=args.cache_dir)]
+
+
+# Function to describe the inputs of a run, so that shards rendered from
+# different data, templates or code are told apart when they are merged
+def run_inputs(args, converter_name):
+    data = [path for path in (args.data, args.crossreg, args.oa_checks, args.corrections) if path]
+    return {
+        "data": manifest.file_digest(*data),
+        "templates": [manifest.file_digest(path) for _, _, path, _ in args.templates],
+        "code": manifest.code_digest(__file__),
+        "converter": converter_name,
+        "svg_format": args.svg_format,
+        "keep_svg": args.keep_svg,
+        "filter": args.filter,
+    }
 
-def url_for_euctr_crossreg(row):
-    url = "https://www.clinicaltrialsregister.eu/ctr-search/search?query=" + row['trn_eudract']
 
-    if not isinstance(url, str):
-        if np.isnan(url):
-            url = ""
-    return url
-
-
-def id_for_publication(row):
-    return row["id"]
-
-
-def get_publication_title(row):
-    citation = row['citation']
-    if not isinstance(citation, str):
-        if np.isnan(citation):
-            citation = "DOI: " + row['doi']
-    cutoff = 50
-    if len(citation) > cutoff:
-        citation = citation[0:cutoff] + "…"
-    return citation
-
-
-def get_registry_name(row):
-    registry = row['registry']
-    if not isinstance(registry, str):
-        if np.isnan(registry):
-            registry = "N/A"
-    return registry
-
-
-def get_days_reg_to_start(row):
-    days_reg_to_start = abs(row['days_reg_to_start'])
-    if np.isnan(days_reg_to_start):
-        days_reg_to_start = "N/A"
-    return days_reg_to_start
-
-
-def get_start_date(row):
-    start_date = row['start_date']
-    if not isinstance(start_date, str):
-        if np.isnan(start_date):
-            start_date = "N/A"
-    return start_date
-
-
-def get_completion_date(row):
-    completion_date = row['completion_date']
-    if not isinstance(completion_date, str):
-        if np.isnan(completion_date):
-            completion_date = "N/A"
-    return completion_date
-
-
-def get_euctr_trn(row):
-    return row["trn_eudract"]
-
-
-def get_trn(row):
-    return "'" + row["id"] + "'"
-
-
-def gen_core_facility_email(_row):
-    email = "mailto:studienergebnisse@charite.de"
-    return email
-
-
-def spacify(name, num=3):
-    def fn(root, row):
-        if row["registry"] != "DRKS":
-            return
-
-        node = get_element(root, name)
-        if node is None:
-            print(f"WARNING {name} not found")
-            return
-        node.text = " "*num + node.text
-    return fn
-
-
-TABLE = {
-    "#open_access": {
-        "has_publication": {
-            False: {"layer": "open_access_layer_na"},
-            True: {
-                "is_oa": {
-                    True: {"layer": "open_access_layer_1"},
-                    np.NaN: {"layer": "open_access_layer_2"},
-                    False: {
-                        "is_closed_archivable": {
-                            True: {"layer": "open_access_layer_3",
-                                   "link_syp": {
-                                       "id": "open_access_improve_3a_syp",
-                                       "url": "https://shareyourpaper.org"
-                                   },
-                                   "link_library": {
-                                       "id": "open_access_improve_3a_library",
-                                       "url": url_for_library
-                                   }},
-                            False: {"layer": "open_access_layer_4"},
-                            np.NaN: {"layer": "open_access_layer_4"}
-                        }
-                    }
-                }
-            }
-        },
-    },
-    "#summary_results": {
-        "has_summary_results": {
-            False: {"layer": "summary_results_layer_1",
-                    "registry": {
-                        "id": "summary_results_registry_1a",
-                        "text": get_registry_name
-                    },
-                    "improve_registry": {
-                        "id": "summary_results_improve_registry_1a",
-                        "text": get_registry_name
-                    },
-                    "improve_sumres_link": {
-                        "id": "summary_results_improve_link_1a",
-                        "url": url_for_improve_sumres
-                    }},
-            True: {
-                "is_summary_results_1y": {
-                    False: {"layer": "summary_results_layer_2",
-                           "registry": {
-                               "id": "summary_results_registry_2a",
-                               "text": get_registry_name
-                           },
-                           "completion_date": {
-                               "id": "summary_results_completion_2b",
-                               "text": get_completion_date
-                           }},
-                    True: {"layer": "summary_results_layer_3",
-                            "registry": {
-                                "id": "summary_results_registry_3a",
-                                "text": get_registry_name,
-                            },
-                            "completion_date": {
-                                "id": "summary_results_completion_3b",
-                                "text": get_completion_date
-                            }}
-                }
-
-            }
-        }
-    },
-    "#publication": {
-        "has_publication": {
-            False: {"layer": "publication_layer_1"},
-            True: {
-                "is_publication_2y": {
-                    False: {"layer": "publication_layer_2",
-                           "link": {
-                               "id": "publication_link_2a",
-                               "url": url_for_publication,
-                               "text": get_publication_title
-                           },
-                           "completion_date": {
-                               "id": "publication_completion_date_2b",
-                               "text": get_completion_date
-                           }},
-                    True: {"layer": "publication_layer_3",
-                            "link": {
-                                "id": "publication_link_3a",
-                                "url": url_for_publication,
-                                "text": get_publication_title
-                            },
-                            "completion_date": {
-                                "id": "publication_completion_date_3b",
-                                "text": get_completion_date
-                            }}
-                }
-            }
-        }
-    },
-    "#linkage_abstract": {
-        "has_publication": {
-            False: {"layer": "linkage_layer_na"},
-            True: {
-                "has_iv_trn_abstract": {
-                    True: {"layer": "linkage_layer_1",
-                           "trn": {
-                               "id": "linkage_trn_1b",
-                               "text": get_trn,
-                               "post": spacify("linkage_text_1b")
-                           }},
-                    False: {"layer": "linkage_layer_2",
-                            "trn": {
-                                "id": "linkage_trn_2b",
-                                "text": get_trn,
-                                "post": spacify("linkage_text_2b")
-                            }}}
-            }
-        }
-    },
-    "#linkage_full_text": {
-        "has_publication": {
-            False: {"layer": "linkage_layer_na"},
-            True: {
-                "has_iv_trn_ft": {
-                    True: {"layer": "linkage_layer_3",
-                           "trn": {
-                               "id": "linkage_trn_3c",
-                               "text": get_trn,
-                               "post": spacify("linkage_text_3c")
-                           }},
-                    False: {"layer": "linkage_layer_4",
-                            "trn": {
-                                "id": "linkage_trn_4c",
-                                "text": get_trn,
-                                "post": spacify("linkage_text_4c")
-                            }}
-                }
-            }
-        }
-    },
-    "#linkage_registry": {
-        "has_publication": {
-            False: {"layer": "linkage_layer_na"},
-            True: {
-                "has_reg_pub_link": {
-                    True: {"layer": "linkage_layer_5"},
-                    False: {"layer": "linkage_layer_6",
-                            "registry": {
-                                "id": "linkage_improve_registry",
-                                "text": get_registry_name
-                            },
-                            "improve_linkage_link": {
-                                "id": "linkage_improve_link",
-                                "url": url_for_improve_link
-                            }}
-                }
-            }
-        }
-    },
-    "#registration": {
-        "is_prospective": {
-            True: {
-                "days_reg_to_start_is_positive": {
-                    True: {"layer": "registration_layer_1",
-                           "registry": {
-                               "id": "registration_registry_1",
-                               "text": get_registry_name
-                           },
-                           "start_date": {
-                               "id": "registration_start_date_1",
-                               "text": get_start_date
-                           }},
-                    False: {"layer": "registration_layer_2",
-                            "registry": {
-                                "id": "registration_registry_2",
-                                "text": get_registry_name
-                            },
-                            "start_date": {
-                                "id": "registration_start_date_2",
-                                "text": get_start_date
-                            }}
-                }
-            },
-            False: {"layer": "registration_layer_3",
-                    "registry": {
-                        "id": "registration_registry_3",
-                        "text": get_registry_name
-                    },
-                    "days_reg_to_start": {
-                        "id": "registration_days_3",
-                        "text": get_days_reg_to_start
-                    },
-                    "start_date": {
-                        "id": "registration_start_date_3",
-                        "text": get_start_date
-                    }},
-        }
-    },
-    "#euctr_crossreg": {
-        "has_valid_crossreg_eudract": {
-            False: {"layer": "euctr_crossreg_layer_na"},
-            True: {
-                "is_prospective_eudract": {
-                    True: {
-                        "has_summary_results_eudract": {
-                            True: {
-                                "layer": "euctr_crossreg_layer_1",
-                                "euctr_trn": {
-                                    "id": "euctr_crossreg_trn_1",
-                                    "text": get_euctr_trn,
-                                    "url": url_for_euctr_crossreg
-                                }},
-                            False: {
-                                "layer": "euctr_crossreg_layer_2",
-                                "euctr_trn": {
-                                    "id": "euctr_crossreg_trn_2",
-                                    "text": get_euctr_trn,
-                                    "url": url_for_euctr_crossreg
-                                },
-                                "improve_euctr_crossreg_link": {
-                                    "id": "euctr_crossreg_improve_link_2",
-                                    "email": gen_core_facility_email
-                                }},
-                        }
-                    },
-                    False: {
-                        "has_summary_results_eudract": {
-                            True: {
-                                "layer": "euctr_crossreg_layer_3",
-                                "euctr_trn": {
-                                    "id": "euctr_crossreg_trn_3",
-                                    "text": get_euctr_trn,
-                                    "url": url_for_euctr_crossreg
-                                }},
-                            False: {
-                                "layer": "euctr_crossreg_layer_4",
-                                "euctr_trn": {
-                                    "id": "euctr_crossreg_trn_4",
-                                    "text": get_euctr_trn,
-                                    "url": url_for_euctr_crossreg
-                                },
-                                "improve_euctr_crossreg_link": {
-                                    "id": "euctr_crossreg_improve_link_4",
-                                    "email": gen_core_facility_email
-                                }},
-                        }
-                    }
-                }
-            }
-        }
-    }
-}
+# State of a render worker, set up once per process by init_worker
+_worker = {}
+
+
+def init_worker(args, converter_name, keep_svg):
+    _worker["profiler"] = None
+    if args.profile:
+        _worker["profiler"] = profiling.TrialProfiler(args.profile, args.cprofile)
+    # The images of the templates are decoded and stored once per worker
+    assets = AssetStore(args.assets) if args.assets else None
+    _worker["renderers"] = [(Renderer(SPECS[spec], path, cache_dir=args.cache_dir, assets=assets),
+                             spec, subdir)
+                            for _, spec, path, subdir in args.templates]
+    _worker["outdir"] = args.outdir
+    _worker["keep_svg"] = keep_svg
+    _worker["svg_format"] = args.svg_format
+    _worker["converter_name"] = converter_name
+    _worker["converter"] = None
+    _worker["store"] = None
+    _worker["journal"] = None
+    if not args.packages:
+        _worker["journal"] = journal.Journal(
+            journal.journal_path(sharding.manifest_path(args.outdir, args.shard)))
+        atexit.register(_worker["journal"].close)
+    _worker["scheduler"] = None
+    if converter_name:
+        # One converter (and so one Inkscape shell) per worker process
+        converter = converters.get_converter(converter_name, args.inkscape, args.timeout, args.retries)
+        atexit.register(converter.close)
+        if assets:
+            converter.use_assets(assets)
+        if args.pdf_cache:
+            _worker["store"] = PdfStore(args.pdf_cache, args.pdf_cache_size * 1024 ** 2)
+            converter = converters.CachingConverter(converter, _worker["store"], converter_name)
+        _worker["converter"] = converter
+        if converter.external:
+            # Converters that start a process per card run them in the
+            # background, while the next cards are built
+            _worker["scheduler"] = SubprocessScheduler(args.subprocesses, args.timeout, args.retries)
+
+
+# Function to render a chunk of trials, recording failures instead of
+# aborting the whole batch. Conversions may still be running when the next
+# card is built; the chunk is done when all of them are.
+def render_chunk(chunk):
+    data, assignments, keys = chunk
+    profiler = _worker["profiler"]
+    converter = _worker["converter"]
+    trials = []
+    records = {spec: a.to_dict("records") for spec, a in assignments.items()}
+    for i, row in enumerate(data.to_dict("records")):
+        # The layers and field values were worked out once for all templates
+        # of the same kind
+        for renderer, spec, subdir in _worker["renderers"]:
+            assignment = records[spec][i]
+            name = card_name(subdir, row['id'])
+            timer = profiler.start(name) if profiler else NULL_TIMER
+            calls = converter.subprocess_calls if converter else 0
+            try:
+                future = render_trial(renderer, row, assignment,
+                                      os.path.join(_worker["outdir"], subdir), converter,
+                                      _worker["keep_svg"], timer, _worker["svg_format"],
+                                      _worker["scheduler"])
+            except Exception as e:
+                future = failed(e)
+            # Each card is journaled as soon as it is done, so that a run
+            # that is killed keeps what it finished; the future's result is
+            # the checksums of the card's files
+            future = then(future, journal_card, name, keys[name])
+            if converter:
+                timer.count("subprocess_calls", converter.subprocess_calls - calls)
+            trials.append((name, timer, future))
+
+    results = []
+    for name, timer, future in trials:
+        error = checksums = None
+        try:
+            checksums = future.result()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        results.append((name, error, checksums))
+        if profiler:
+            profiler.finish(name, timer, error)
+    if profiler:
+        profiler.flush()
+    if _worker["store"]:
+        _worker["store"].flush_stats()
+    return results
+
+
+# Function to record a finished card in the journal; returns the checksums
+# of its files
+def journal_card(name, key):
+    files = output_files(_worker["outdir"], name, _worker["converter_name"], _worker["keep_svg"],
+                         _worker["svg_format"])
+    return _worker["journal"].record(name, key, files)
+
+
+# Function to render a chunk of trials straight to PDF bytes, for the
+# packages pipeline; results carry the PDF as a third element
+def render_chunk_to_memory(chunk):
+    data, assignments, _ = chunk
+    profiler = _worker["profiler"]
+    renderer, spec, _ = _worker["renderers"][0]
+    results = []
+    for row, assignment in zip(data.to_dict("records"), assignments[spec].to_dict("records")):
+        name = row['id']
+        timer = profiler.start(name) if profiler else NULL_TIMER
+        calls = _worker["converter"].subprocess_calls
+        try:
+            svg = renderer.render(row, assignment, _worker["svg_format"], timer)
+            with timer.stage("convert"):
+                pdf = _worker["converter"].convert_to_bytes(svg)
+        except Exception as e:
+            results.append((name, f"{type(e).__name__}: {e}", None))
+        else:
+            results.append((name, None, pdf))
+        if profiler:
+            timer.count("subprocess_calls", _worker["converter"].subprocess_calls - calls)
+            profiler.finish(name, timer, results[-1][1])
+    if profiler:
+        profiler.flush()
+    if _worker["store"]:
+        _worker["store"].flush_stats()
+    return results
+
+
+# Function to open the PDF cache asked for on the command line, if any
+def open_pdf_store(args):
+    if not args.pdf_cache or args.no_pdf:
+        return None
+    return PdfStore(args.pdf_cache, args.pdf_cache_size * 1024 ** 2)
+
+
+# Function to trim the PDF cache after a run and report how it was used
+def close_pdf_store(pdf_store, before):
+    evicted = pdf_store.evict()
+    after = pdf_store.stats()
+    print(f"PDF cache: {after['hits'] - before['hits']} hits, "
+          f"{after['misses'] - before['misses']} misses, {evicted} evicted", file=sys.stderr)
+
+
+# Function to feed the rendered cards to the package assembler as they
+# come in, collecting the results of the packages they complete
+def assemble_packages(results, assembler, package_results):
+    for name, error, pdf in results:
+        package_results.extend(assembler.add(name, pdf, error))
+        yield name, error
+    package_results.extend(assembler.finish())
+
+
+# Function to run the fused pipeline: render the cards the packages need
+# in memory and merge them into the packages without intermediate files
+def package_pipeline(args, batches):
+    packages = packaging.read_packages(pd.read_csv(args.packages))
+    packages = [(name, trials) for name, trials in packages if sharding.owns(args.shard, name)]
+    needed = {trial for _, trials in packages for trial in trials}
+
+    # Check the letters and the info sheet before rendering anything
+    sources = [os.path.join(args.letters_dir, f"{name}.pdf") for name, _ in packages]
+    missing = packaging.find_missing(sources + [args.infosheet])
+    if missing:
+        print(f"{len(missing)} files are missing:", file=sys.stderr)
+        for path in missing:
+            print(f"  {path}", file=sys.stderr)
+        sys.exit(1)
+
+    # Only render the cards some package lists
+    batches = (data[data['id'].isin(needed)] for data in batches)
+    work = plan_work(batches, args, args.converter)
+
+    pdf_store = open_pdf_store(args)
+    before = pdf_store.stats() if pdf_store else None
+    initargs = (args, args.converter, False)
+    assembler = packaging.PackageAssembler(packages, args.letters_dir, args.infosheet, args.outdir)
+    package_results = []
+
+    results = parallel.run_chunks(render_chunk_to_memory, work, jobs=args.jobs,
+                                  initializer=init_worker, initargs=initargs)
+    results = assemble_packages(results, assembler, package_results)
+    failures, count = parallel.report_progress(results)
+    parallel.print_summary(failures, count)
+    if pdf_store:
+        close_pdf_store(pdf_store, before)
+    if args.profile:
+        profiling.print_summary(profiling.summarize(args.profile))
+
+    package_failures = [(name, error) for name, error in package_results if error is not None]
+    parallel.print_summary(package_failures, len(package_results), what="packages created")
+
+    if args.shard:
+        # Every package of the shard, whether built or failed (see merge-shards.py)
+        keys = {name: manifest.card_key(name, trials) for name, trials in packages}
+        inputs = dict(run_inputs(args, args.converter), packages=manifest.file_digest(args.packages),
+                      infosheet=manifest.file_digest(args.infosheet))
+        sharding.save_packages(args.outdir, args.shard, keys,
+                               [name for name, error in package_results if error is None], inputs)
+
+    if failures or package_failures:
+        sys.exit(1)
 
 
 def main():
     parser = argparse.ArgumentParser(description='Create report cards')
-    parser.add_argument('template', metavar='TEMPLATE', type=str,
-                        help='The template to use')
+    parser.add_argument('templates', metavar='TEMPLATE', type=str, nargs='+',
+                        help='The template to use, as [LABEL=][SPEC:]PATH with SPEC the kind of card '
+                             f'({", ".join(sorted(SPECS))}; default: {DEFAULT_SPEC}); give several to render '
+                             'every trial with each of them in one pass, into a subdirectory per label')
     parser.add_argument('data', metavar='DATA', type=str,
                         help='The data to use (.csv file)')
     parser.add_argument('--outdir', metavar='DIR', type=str,
                         default=os.getcwd(), dest="outdir",
                         help='Where to store the output (default: current work dir)')
+    parser.add_argument('--crossreg', metavar='FILE', type=str,
+                        help='Join the checked EUCTR cross-registrations (crossreg-euctr-data.csv) into DATA, '
+                             'which is then the raw trackvalue.csv')
+    parser.add_argument('--oa-checks', metavar='FILE', type=str,
+                        help='Apply the manual open access checks (oa-checks.csv) to DATA')
+    parser.add_argument('--corrections', metavar='FILE', type=str,
+                        help='Apply manual corrections (id, column, value) to DATA')
     parser.add_argument('--filter', metavar='FILTER', type=str,
                         help='Filter trials by TRN')
     parser.add_argument('--no-pdf', action="store_true", default=False,
                         help='Do not produce the pdf')
+    parser.add_argument('--cache-dir', metavar='DIR', type=str,
+                        help='Where to keep the compiled template index (and a Parquet copy of the data) between runs')
+    parser.add_argument('--jobs', metavar='N', type=int, default=1,
+                        help='Number of worker processes (default: 1)')
+    parser.add_argument('--converter', choices=sorted(converters.CONVERTERS),
+                        default="inkscape-shell",
+                        help='How to convert SVG to PDF (default: inkscape-shell)')
+    parser.add_argument('--inkscape', metavar='PATH', type=str,
+                        help='The Inkscape binary (default: $INKSCAPE, the PATH or the usual install locations)')
+    parser.add_argument('--subprocesses', metavar='N', type=int, default=1,
+                        help='Conversions each worker runs at the same time with a converter that starts '
+                             'a process per card (inkscape) (default: 1)')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=120,
+                        help='Kill a conversion that takes longer than this (default: 120)')
+    parser.add_argument('--retries', metavar='N', type=int, default=1,
+                        help='Times a failed or killed conversion is retried (default: 1)')
+    parser.add_argument('--keep-svg', action="store_true", default=False,
+                        help='Also write the SVG when converting in process (e.g. with cairosvg)')
+    parser.add_argument('--svg-format', choices=sorted(SVG_FORMATS), default="pretty",
+                        help='Write the SVG pretty printed, compact or gzipped as .svgz (default: pretty)')
+    parser.add_argument('--assets', metavar='DIR', type=str,
+                        help='Move the images embedded in the template to this directory (stored by content) '
+                             'and only refer to them from the cards, which makes every card much smaller')
+    parser.add_argument('--pdf-cache', metavar='DIR', type=str,
+                        help='Keep converted PDFs in this directory, keyed by the content of the SVG, '
+                             'and reuse them for identical cards')
+    parser.add_argument('--pdf-cache-size', metavar='MB', type=int, default=2048,
+                        help='Size the PDF cache is trimmed to after each run, least recently used first '
+                             '(default: 2048)')
+    parser.add_argument('--assignments', metavar='FILE', type=str,
+                        help='Write the layers and fields chosen for each trial to this .csv file')
+    parser.add_argument('--dry-run', action="store_true", default=False,
+                        help='Only compute the layer assignments, do not render')
+    parser.add_argument('--force', action="store_true", default=False,
+                        help='Render all cards, even those unchanged since the last run')
+    parser.add_argument('--verify', action="store_true", default=False,
+                        help='Check the outputs of unchanged cards against the checksums recorded for them '
+                             'before skipping them, and render those that differ again')
+    parser.add_argument('--shard', metavar='I/N', type=sharding.parse_shard,
+                        help='Only render the I-th of N slices of the trials (of the trialists with --packages), '
+                             'so that N machines can share a run; see merge-shards.py')
+    parser.add_argument('--chunksize', metavar='N', type=int,
+                        help='Stream the data in batches of N trials instead of loading it at once')
+    parser.add_argument('--profile', metavar='DIR', type=str,
+                        help='Time every stage of every trial and write the profile to this directory')
+    parser.add_argument('--cprofile', action="store_true", default=False,
+                        help='With --profile, also collect a cProfile dump (cprofile.prof)')
+    parser.add_argument('--packages', metavar='PARAMS', type=str,
+                        help='Build the email attachments listed in this .csv file (email parameters) '
+                             'directly, rendering each card once in memory')
+    parser.add_argument('--letters_dir', metavar='DIR', type=str,
+                        default=os.getcwd(), dest="letters_dir",
+                        help='With --packages, where to get the invitation letters from (default: current work dir)')
+    parser.add_argument('--infosheet', metavar='FILE', type=str,
+                        default="infosheet.pdf",
+                        help='With --packages, the info sheet appended to every package (default: infosheet.pdf)')
 
     args = parser.parse_args()
 
-    os.makedirs(args.outdir, exist_ok=True)
-
-    infile = args.template
-
-    with open(infile, "rb") as f:
-        data = f.read()
-
-    # Define XML template
-    template = etree.fromstring(data)
-
-    # Define layer characteristics in each module
-    layers = [{'name': 'registration', 'number': 3, 'na': False},
-              {'name': 'summary_results', 'number': 3, 'na': False},
-              {'name': 'publication', 'number': 3, 'na': False},
-              {'name': 'linkage', 'number': 6, 'na': True},
-              {'name': 'open_access', 'number': 4, 'na': True},
-              {'name': 'euctr_crossreg', 'number': 4, 'na': True}]
+    args.templates = parse_templates(args.templates)
+    if len({label for label, _, _, _ in args.templates}) < len(args.templates):
+        parser.error("every template needs a different label")
+    if args.packages and args.no_pdf:
+        parser.error("--packages needs PDFs, it cannot be combined with --no-pdf")
+    if args.packages and len(args.templates) > 1:
+        parser.error("--packages builds the packages from one template at a time")
+    if args.cprofile and not args.profile:
+        parser.error("--cprofile needs --profile")
+    for problem in check_templates(args.templates, args.cache_dir):
+        parser.error(problem)
+    if args.profile:
+        profiling.reset(args.profile)
+
+    # Fail early rather than in every worker when the converter is unusable
+    if not args.no_pdf and not args.dry_run:
+        try:
+            converters.get_converter(args.converter, args.inkscape, args.timeout, args.retries).close()
+        except (FileNotFoundError, converters.ConversionError) as e:
+            parser.error(str(e))
+
+    for _, _, _, subdir in args.templates:
+        os.makedirs(os.path.join(args.outdir, subdir), exist_ok=True)
+
+    try:
+        batches = load_batches(args)
+    except ValueError as e:
+        # The checked sources do not fit the data (see reportcards/sources.py)
+        parser.error(str(e))
+    if args.shard and not args.packages:
+        # Packages are sharded by trialist instead, see package_pipeline
+        batches = (sharding.select(data, 'id', args.shard) for data in batches)
+
+    if args.dry_run:
+        for i, data in enumerate(batches):
+            assign_batch(data, args, first=i == 0)
+        return
 
-    # Build a set of all layers
-    all_layers = get_all_layers(layers)
+    if args.packages:
+        package_pipeline(args, batches)
+        return
 
-    # Read in the data with trial-specific characteristics
-    data = pd.read_csv(args.data)
+    converter_name = None if args.no_pdf else args.converter
+    # Each shard keeps its own manifest, as several machines may be writing
+    # to the output directory at the same time (see merge-shards.py)
+    built = manifest.Manifest.load(sharding.manifest_path(args.outdir, args.shard))
+
+    # Take over the cards an interrupted run finished (see reportcards/journal.py)
+    # and clear away what it left half-done
+    journal_file = journal.journal_path(built.path)
+    recovered, repaired = journal.recover(built, journal_file, args.outdir)
+    for _, _, _, subdir in args.templates:
+        repaired += journal.remove_partial(os.path.join(args.outdir, subdir),
+                                           lambda name: sharding.owns(args.shard, name))
+    if recovered or repaired:
+        built.save()
+        print(f"Resuming an interrupted run: {recovered} report cards finished, "
+              f"{repaired} half-written outputs removed", file=sys.stderr)
+    journal.remove_journal(journal_file)
+
+    keys = {}
+    stats = {"skipped": 0}
+    work = plan_work(batches, args, converter_name, built, keys, stats)
+
+    # Unless streaming, plan everything first so progress shows a total
+    total = None
+    if not args.chunksize:
+        work = list(work)
+        total = sum(len(chunk) for chunk, _, _ in work) * len(args.templates)
+
+    pdf_store = open_pdf_store(args)
+    before = pdf_store.stats() if pdf_store else None
+    initargs = (args, converter_name, args.keep_svg)
 
     # Iterate over each trial and select template to be used for each module
-    for _, row in data.iterrows():
-        # Use base XML content on each run
-        root = copy.deepcopy(template)
-        included_layers = set()
-        name = row['id']
-        outfile = os.path.join(args.outdir, f"{name}.svg")
-
-        if args.filter and not fnmatch.fnmatch(name, args.filter):
-            continue
-
-        # Add trial registration number
-        replace(root, "g", "TRN", row['id'] + ":", gen_registry_url(row))
-        # Add title of trial
-        title = row['title']
-        cutoff = 105
-        if len(title) > cutoff:
-            title = title[0:cutoff] + "…"
-        replace(root, "g", "title", title)
-
-        for key, value in TABLE.items():
-            if key.startswith("#"):
-                key = next(iter(value))  # get the new key
-                value = value[key]       # get new value
-
-            element = value
-            while key != "layer":
-                condition = row[key]
-                value = value[condition]  # go one level deeper
-                key = next(iter(value))   # get the new key
-                element = value
-                value = value[key]
-
-            for k, v in element.items():
-                if k == "layer":
-                    included_layers.add(v)
-                    continue
-
-                assert isinstance(v, dict)  # mainly to keep the linter happy
-                the_id = v["id"]
-                text = v.get("text")
-                url = v.get("url") or v.get("email")
-
-                if text and callable(text):
-                    text = text(row)
-                if url and callable(url):
-                    url = url(row)
-
-                replace(root, "g", the_id, text, url)
-
-                post = v.get("post")
-                if post:
-                    post(root, row)
-
-        # Define which layers need to be excluded for this trial
-        layers_to_exclude = all_layers - included_layers
-
-        remove_layers(root, layers_to_exclude)
-
-        # objectify.deannotate(root)
-        # etree.cleanup_namespaces(root)
-        out = etree.tostring(root, pretty_print=True, encoding="utf-8")
-
-        with open(outfile, "wb") as f:
-            f.write(out)
-
-        # optionally skip the pdf if requested
-        if args.no_pdf:
-            continue
-
-        outpdf = os.path.join(args.outdir, f"{name}.pdf")
-
-        # Convert modified SVG to PDF with inkscape (open source)
-        subprocess.run([
-            "/Applications/Inkscape.app/Contents/MacOS/inkscape",
-            f"--export-filename={outpdf}",
-            outfile,
-        ], check=True)
+    results = parallel.run_chunks(render_chunk, work, jobs=args.jobs,
+                                  initializer=init_worker, initargs=initargs)
+    results = record_results(results, built, keys, args.outdir, converter_name, args.keep_svg,
+                             args.svg_format)
+    try:
+        failures, count = parallel.report_progress(results, total)
+    finally:
+        # Keep what was rendered, also when the run is interrupted; once it
+        # is in the manifest the journal is no longer needed
+        built.save()
+        journal.remove_journal(journal_file)
+
+    if args.shard:
+        # All cards of the shard were planned (keys), whether rendered now,
+        # skipped or failed
+        sharding.save_plan(args.outdir, args.shard, keys, run_inputs(args, converter_name))
+
+    if stats["skipped"]:
+        print(f"{stats['skipped']} unchanged report cards skipped", file=sys.stderr)
+    parallel.print_summary(failures, count)
+    if pdf_store:
+        close_pdf_store(pdf_store, before)
+    if args.profile:
+        profiling.print_summary(profiling.summarize(args.profile))
+
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,36 @@
+#!/usr/bin/python3
+import argparse
+import sys
+
+from reportcards import sharding
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the shards of a run of gen-report-cards-merged.py or create-package.py --shard '
+                    'and merge their manifests')
+    parser.add_argument('outdir', metavar='DIR', type=str,
+                        help='The output directory the shards rendered (or built their packages) into')
+
+    args = parser.parse_args()
+
+    problems = sharding.merge(args.outdir)
+    if not problems:
+        print("All shards complete", file=sys.stderr)
+        return
+
+    titles = {
+        "shards": "Shards",
+        "inputs": "Shards rendered from different inputs",
+        "duplicates": "Cards (or packages) claimed by more than one shard",
+        "missing": "Cards (or packages) missing (failed, not built or deleted)",
+    }
+    for kind, found in problems.items():
+        print(f"{titles[kind]} ({len(found)}):", file=sys.stderr)
+        for problem in found:
+            print(f"  {problem}", file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
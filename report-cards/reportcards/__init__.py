@@ -0,0 +1,3 @@
+from .template import CompiledTemplate, Card, SVG_NS, XLINK_NS
+from .decision import DecisionTable
+from .render import CardSpec, Renderer
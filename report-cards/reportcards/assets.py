@@ -0,0 +1,104 @@
+import base64
+import binascii
+import hashlib
+import os
+import pathlib
+import tempfile
+import urllib.parse
+
+from .store import FILE_MODE
+from .template import XLINK_NS
+
+
+# File extensions of the image types found in data: URIs
+EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/svg+xml": ".svg",
+}
+
+
+class AssetStore:
+    """Content-addressed directory of the images embedded in templates.
+
+    Each image is written once, under the hash of its content, and cards
+    refer to it by file URI instead of carrying its base64 text. Files
+    read back (e.g. by an in-process converter) are kept decoded in
+    memory, so each is read once per process.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self._loaded = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    # Function to add an image; returns its path in the store
+    def put(self, data, extension):
+        path = os.path.join(self.directory, hashlib.sha256(data).hexdigest() + extension)
+        if os.path.exists(path):
+            return path
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            # Readable by the web server and other users, as files from open() would be
+            os.chmod(tmp, FILE_MODE)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return path
+
+    # Function to tell whether a URL points into the store
+    def owns(self, url):
+        path = _file_path(url)
+        return path is not None and os.path.dirname(path) == self.directory
+
+    # Function to move the base64 images of an SVG tree into the store,
+    # pointing their hrefs at the stored files instead; returns the number
+    # of images moved
+    def externalize(self, root):
+        moved = 0
+        for attribute in (f"{{{XLINK_NS}}}href", "href"):
+            for node in root.iter("{*}image"):
+                decoded = _decode_data_uri(node.get(attribute))
+                if decoded is None:
+                    continue
+                media_type, data = decoded
+                path = self.put(data, EXTENSIONS.get(media_type, ""))
+                node.set(attribute, pathlib.Path(path).as_uri())
+                moved += 1
+        return moved
+
+    # Function to read an image of the store by its file URI
+    def read(self, url):
+        path = _file_path(url)
+        data = self._loaded.get(path)
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+            self._loaded[path] = data
+        return data
+
+
+# Function to split a base64 data: URI into (media type, bytes); None for
+# anything else
+def _decode_data_uri(href):
+    if not href or not href.startswith("data:"):
+        return None
+    header, sep, payload = href[5:].partition(",")
+    if not sep or not header.endswith(";base64"):
+        return None
+    try:
+        data = base64.b64decode("".join(payload.split()), validate=True)
+    except binascii.Error:
+        return None
+    return header[:-len(";base64")].split(";")[0], data
+
+
+def _file_path(url):
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme != "file":
+        return None
+    return os.path.abspath(urllib.parse.unquote(parts.path))
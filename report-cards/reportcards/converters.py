@@ -0,0 +1,393 @@
+import os
+import select
+import shutil
+import subprocess
+import tempfile
+
+from .scheduler import completed, then
+
+
+# Places to look for Inkscape when it is not on the PATH
+INKSCAPE_LOCATIONS = [
+    "/usr/bin/inkscape",
+    "/usr/local/bin/inkscape",
+    "/snap/bin/inkscape",
+    "/var/lib/flatpak/exports/bin/org.inkscape.Inkscape",
+    "/Applications/Inkscape.app/Contents/MacOS/inkscape",
+]
+
+
+class ConversionError(Exception):
+    pass
+
+
+# Function to locate the Inkscape binary: an explicit path wins, then the
+# INKSCAPE environment variable, then the PATH, then the usual install dirs
+def find_inkscape(path=None):
+    if path:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Inkscape not found at {path}")
+        return path
+
+    path = os.environ.get("INKSCAPE") or shutil.which("inkscape")
+    if path:
+        return path
+
+    for location in INKSCAPE_LOCATIONS:
+        if os.path.exists(location):
+            return location
+
+    raise FileNotFoundError("Inkscape not found; pass --inkscape or set INKSCAPE")
+
+
+class Converter:
+    """Interface of the SVG to PDF backends.
+
+    `convert` takes an SVG file, `convert_bytes` an SVG document in memory.
+    Backends that run inside the process (`in_process`) convert from
+    memory directly; the others get the bytes through a temporary file.
+    """
+
+    # Whether the backend needs an external binary (see find_inkscape)
+    external = False
+    in_process = False
+    # Number of processes started so far, for profiling
+    subprocess_calls = 0
+
+    def convert(self, svg_path, pdf_path):
+        raise NotImplementedError
+
+    # Function to tell the backend where the images of cards rendered with
+    # an AssetStore (see assets.py) live; backends reading them from disk
+    # by themselves ignore it
+    def use_assets(self, assets):
+        pass
+
+    # Function to start converting a file; returns a Future. Backends that
+    # run one command per file hand it to the SubprocessScheduler, the
+    # others convert right away.
+    def submit(self, svg_path, pdf_path, scheduler):
+        return completed(self.convert, svg_path, pdf_path)
+
+    def convert_bytes(self, svg, pdf_path):
+        fd, svg_path = tempfile.mkstemp(suffix=".svg", dir=os.path.dirname(os.path.abspath(pdf_path)))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(svg)
+            self.convert(svg_path, pdf_path)
+        finally:
+            os.remove(svg_path)
+
+    # Function to convert an SVG document in memory to PDF bytes
+    def convert_to_bytes(self, svg):
+        with tempfile.TemporaryDirectory() as tmp:
+            pdf_path = os.path.join(tmp, "card.pdf")
+            self.convert_bytes(svg, pdf_path)
+            with open(pdf_path, "rb") as f:
+                return f.read()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class InkscapeConverter(Converter):
+    """Convert SVG to PDF by starting one Inkscape process per file.
+
+    A conversion that fails or does not finish within `timeout` seconds is
+    killed and retried up to `retries` times, as the SubprocessScheduler
+    does for submitted ones.
+    """
+
+    external = True
+
+    def __init__(self, binary=None, timeout=120, retries=1):
+        self.binary = find_inkscape(binary)
+        self.timeout = timeout
+        self.retries = retries
+
+    def command(self, svg_path, pdf_path):
+        return [
+            self.binary,
+            f"--export-filename={pdf_path}",
+            svg_path,
+        ]
+
+    def convert(self, svg_path, pdf_path):
+        for attempt in range(self.retries + 1):
+            try:
+                return self._convert_once(svg_path, pdf_path)
+            except ConversionError as e:
+                error = e
+        raise ConversionError(f"{error} (tried {self.retries + 1} times)")
+
+    def _convert_once(self, svg_path, pdf_path):
+        self.subprocess_calls += 1
+        try:
+            subprocess.run(self.command(svg_path, pdf_path), check=True, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            raise ConversionError(f"Inkscape did not finish within {self.timeout}s")
+        except subprocess.CalledProcessError as e:
+            raise ConversionError(f"Inkscape exited with {e.returncode}")
+
+    def submit(self, svg_path, pdf_path, scheduler):
+        self.subprocess_calls += 1
+        return scheduler.submit(self.command(svg_path, pdf_path), output=pdf_path)
+
+
+class InkscapeShellConverter(InkscapeConverter):
+    """Convert SVG to PDF through one long-lived `inkscape --shell` process.
+
+    Exports are sent as action lines and the converter waits for the next
+    shell prompt before returning, so Inkscape only starts up once per
+    converter instead of once per card. The shell exits by itself when
+    its stdin is closed, e.g. when the owning worker process goes away.
+    """
+
+    PROMPT = b"> "
+
+    def __init__(self, binary=None, timeout=120, retries=1):
+        super().__init__(binary, timeout, retries)
+        self.process = None
+
+    # The shell converts one file at a time, and has its own timeout (a
+    # shell that times out or exits is started again for the next attempt)
+    def submit(self, svg_path, pdf_path, scheduler):
+        return completed(self.convert, svg_path, pdf_path)
+
+    def _start(self):
+        self.subprocess_calls += 1
+        self.process = subprocess.Popen(
+            [self.binary, "--shell"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        self._read_until_prompt()
+
+    # Function to consume the shell output up to (and including) the prompt
+    def _read_until_prompt(self):
+        fd = self.process.stdout.fileno()
+        output = b""
+        while not output.endswith(self.PROMPT):
+            ready, _, _ = select.select([fd], [], [], self.timeout)
+            if not ready:
+                self._kill()
+                raise ConversionError(f"Inkscape did not respond within {self.timeout}s")
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                self._kill()
+                raise ConversionError("Inkscape shell exited unexpectedly")
+            output += chunk
+        return output
+
+    def _kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def convert(self, svg_path, pdf_path):
+        svg_path = os.path.abspath(svg_path)
+        pdf_path = os.path.abspath(pdf_path)
+        if ";" in svg_path or ";" in pdf_path:
+            raise ConversionError("paths passed to the Inkscape shell cannot contain ';'")
+        super().convert(svg_path, pdf_path)
+
+    def _convert_once(self, svg_path, pdf_path):
+        # Start the shell, or start it again if it exited since the last export
+        if self.process is not None and self.process.poll() is not None:
+            self._kill()
+        if self.process is None:
+            self._start()
+
+        # Remove any stale output so a failed export cannot go unnoticed
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+
+        actions = (f"file-open:{svg_path}; export-filename:{pdf_path}; "
+                   f"export-do; file-close\n")
+        # A shell that goes away while being written to is started again on
+        # the next attempt
+        try:
+            self.process.stdin.write(actions.encode("utf-8"))
+            self.process.stdin.flush()
+        except OSError as e:
+            self._kill()
+            raise ConversionError(f"Inkscape shell exited unexpectedly ({e})")
+        self._read_until_prompt()
+
+        if not os.path.exists(pdf_path) or os.path.getsize(pdf_path) == 0:
+            raise ConversionError(f"Inkscape did not write {pdf_path}")
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write(b"quit\n")
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+class CairoSVGConverter(Converter):
+    """Convert SVG to PDF inside the process with CairoSVG.
+
+    Needs the optional `cairosvg` package (and the cairo library), but no
+    external binary, and converts straight from memory.
+    """
+
+    in_process = True
+
+    def __init__(self):
+        try:
+            import cairosvg
+        except (ImportError, OSError) as e:
+            # cairocffi raises OSError when libcairo itself is missing
+            raise ConversionError(f"the cairosvg converter needs cairosvg and libcairo ({e})")
+        self.cairosvg = cairosvg
+        self.options = {}
+
+    # Images in the asset store are read once and then served from memory;
+    # anything else is fetched as cairosvg would by default
+    def use_assets(self, assets):
+        from cairosvg.url import safe_fetch
+
+        def fetch(url, resource_type):
+            if assets.owns(url):
+                return assets.read(url)
+            return safe_fetch(url, resource_type)
+        self.options["url_fetcher"] = fetch
+
+    def convert(self, svg_path, pdf_path):
+        self.cairosvg.svg2pdf(url=svg_path, write_to=pdf_path, **self.options)
+
+    def convert_bytes(self, svg, pdf_path):
+        self.cairosvg.svg2pdf(bytestring=svg, write_to=pdf_path, **self.options)
+
+    def convert_to_bytes(self, svg):
+        return self.cairosvg.svg2pdf(bytestring=svg, **self.options)
+
+
+# Function to build a valid, empty one-page PDF (sizes in points)
+def blank_pdf(width=842, height=595):
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] >>".encode("ascii"),
+    ]
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n".encode("ascii") + obj + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode("ascii")
+    out += (f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+            f"startxref\n{xref}\n%%EOF\n").encode("ascii")
+    return out
+
+
+class StubConverter(Converter):
+    """Writes an empty page instead of converting, for benchmarks on
+    machines without Inkscape or cairo. Not in CONVERTERS, so that the
+    tools making real cards cannot be given it."""
+
+    in_process = True
+
+    def convert(self, svg_path, pdf_path):
+        with open(pdf_path, "wb") as f:
+            f.write(blank_pdf())
+
+    def convert_bytes(self, svg, pdf_path):
+        self.convert(None, pdf_path)
+
+    def convert_to_bytes(self, svg):
+        return blank_pdf()
+
+
+class CachingConverter(Converter):
+    """Wraps a converter so that PDFs come from a PdfStore (see store.py)
+    when the same SVG was converted before, by any run."""
+
+    def __init__(self, converter, store, name):
+        self.converter = converter
+        self.store = store
+        self.name = name
+        self.external = converter.external
+        self.in_process = converter.in_process
+
+    @property
+    def subprocess_calls(self):
+        return self.converter.subprocess_calls
+
+    def use_assets(self, assets):
+        self.converter.use_assets(assets)
+
+    def convert(self, svg_path, pdf_path):
+        with open(svg_path, "rb") as f:
+            key = self.store.key(f.read(), self.name)
+        cached = self.store.get(key)
+        if cached is not None:
+            shutil.copyfile(cached, pdf_path)
+            return
+        self.converter.convert(svg_path, pdf_path)
+        self.store.put(key, pdf_path=pdf_path)
+
+    def submit(self, svg_path, pdf_path, scheduler):
+        with open(svg_path, "rb") as f:
+            key = self.store.key(f.read(), self.name)
+        cached = self.store.get(key)
+        if cached is not None:
+            return completed(shutil.copyfile, cached, pdf_path)
+        # The returned Future is only done once the PDF is in the store
+        return then(self.converter.submit(svg_path, pdf_path, scheduler),
+                    self.store.put, key, pdf_path)
+
+    def convert_bytes(self, svg, pdf_path):
+        key = self.store.key(svg, self.name)
+        cached = self.store.get(key)
+        if cached is not None:
+            shutil.copyfile(cached, pdf_path)
+            return
+        self.converter.convert_bytes(svg, pdf_path)
+        self.store.put(key, pdf_path=pdf_path)
+
+    def convert_to_bytes(self, svg):
+        key = self.store.key(svg, self.name)
+        cached = self.store.get(key)
+        if cached is not None:
+            with open(cached, "rb") as f:
+                return f.read()
+        pdf = self.converter.convert_to_bytes(svg)
+        self.store.put(key, pdf=pdf)
+        return pdf
+
+    def close(self):
+        self.store.flush_stats()
+        self.converter.close()
+
+
+CONVERTERS = {
+    "inkscape": InkscapeConverter,
+    "inkscape-shell": InkscapeShellConverter,
+    "cairosvg": CairoSVGConverter,
+}
+
+
+# Function to build a converter by name (see CONVERTERS); Inkscape gets
+# `timeout` seconds per conversion and `retries` more attempts
+def get_converter(name, inkscape=None, timeout=120, retries=1):
+    if name not in CONVERTERS:
+        raise ValueError(f"Unknown converter {name}")
+    if CONVERTERS[name].external:
+        return CONVERTERS[name](inkscape, timeout, retries)
+    return CONVERTERS[name]()
@@ -0,0 +1,133 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+
+# Function to tell whether a branch key of the decision tree stands for
+# missing values (np.NaN as a dict key only matches itself by identity)
+def is_missing_key(condition):
+    return isinstance(condition, float) and np.isnan(condition)
+
+
+# Function to list the leaves below one node of the decision tree as
+# (conditions, element) pairs, where conditions are (column, value) pairs
+def get_leaves(node, conditions=()):
+    key = next(iter(node))
+    if key == "layer":
+        return [(conditions, node)]
+
+    leaves = []
+    for condition, child in node[key].items():
+        leaves.extend(get_leaves(child, conditions + ((key, condition),)))
+    return leaves
+
+
+# Function to build the mask of rows where `column` takes the branch `condition`.
+# Equality follows dict lookups (True == 1 == 1.0), missing values only
+# take an explicit NaN branch.
+def condition_mask(column, condition):
+    if is_missing_key(condition):
+        return column.isna()
+    # Nullable columns compare to NA on missing values; those never match
+    return (column == condition).fillna(False).astype(bool) & column.notna()
+
+
+class DecisionTable:
+    """The TABLE decision tree, compiled into leaves that can be selected
+    for a whole DataFrame at once with boolean masks."""
+
+    def __init__(self, table):
+        self.modules = []
+        # Post-processing hooks by field id (e.g. spacify)
+        self.posts = {}
+        for module, node in table.items():
+            leaves = get_leaves(node)
+            self.modules.append((module.lstrip("#"), leaves))
+            for _, element in leaves:
+                for k, v in element.items():
+                    if k != "layer" and v.get("post"):
+                        self.posts[v["id"]] = v["post"]
+
+    # Function to select, for every trial, the layer of each module and the
+    # text/url of every field in it. Returns a DataFrame with the same index
+    # as `data`: one column per module with the chosen layer, `fields` with
+    # a list of (id, text, url) and `error` for trials no branch matches or
+    # whose fields cannot be computed (so that only those trials fail).
+    def assign(self, data):
+        result = pd.DataFrame(index=data.index)
+        fields = pd.Series([[] for _ in range(len(data))], index=data.index, dtype=object)
+        errors = pd.Series([None] * len(data), index=data.index, dtype=object)
+
+        for module, leaves in self.modules:
+            layer = pd.Series([None] * len(data), index=data.index, dtype=object)
+            matched = pd.Series(False, index=data.index)
+
+            for conditions, element in leaves:
+                mask = pd.Series(True, index=data.index)
+                for column, condition in conditions:
+                    mask &= condition_mask(data[column], condition)
+                mask &= ~matched
+                if not mask.any():
+                    continue
+                matched |= mask
+                layer[mask] = element["layer"]
+
+                specs = [(v["id"], v.get("text"), v.get("url") or v.get("email"))
+                         for k, v in element.items() if k != "layer"]
+                _evaluate(specs, data[mask], fields, errors)
+
+            unmatched = ~matched & errors.isna()
+            errors[unmatched] = f"no branch of {module} matches this trial"
+            result[module] = layer
+
+        result["fields"] = fields
+        result["error"] = errors
+        return result
+
+    # Function to turn an assignment table into something readable as CSV,
+    # one row per trial starting with its id (with `append`, add rows to an
+    # existing file, e.g. when streaming)
+    @staticmethod
+    def to_csv(assignments, ids, path, append=False):
+        out = assignments.copy()
+        out.insert(0, "id", ids)
+        out["fields"] = [
+            json.dumps({the_id: {"text": _plain(text), "url": url} for the_id, text, url in row})
+            for row in out["fields"]
+        ]
+        out.to_csv(path, mode="a" if append else "w", header=not append, index=False)
+
+
+# Function to compute the text and url of a leaf's fields for all selected
+# rows, appending (id, text, url) to `fields`. Values can be constants or
+# functions of the row (as in TABLE); the rows are built once for all of
+# them. A function that fails on a row leaves the value empty and notes the
+# error for that trial.
+def _evaluate(specs, selected, fields, errors):
+    if not any(callable(value) for _, text, url in specs for value in (text, url)):
+        for i in selected.index:
+            fields[i].extend(specs)
+        return
+
+    for i, row in zip(selected.index, selected.to_dict("records")):
+        for the_id, text, url in specs:
+            try:
+                if callable(text):
+                    text = text(row)
+                if callable(url):
+                    url = url(row)
+            except Exception as e:
+                text = url = None
+                if errors.at[i] is None:
+                    # Renderer.fill raises the error as a RuntimeError
+                    errors.at[i] = str(e) if isinstance(e, RuntimeError) else f"{type(e).__name__}: {e}"
+            fields[i].append((the_id, text, url))
+
+
+def _plain(value):
+    if value is None or value is pd.NA:
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
@@ -0,0 +1,94 @@
+import pandas as pd
+
+from . import schema
+
+
+# Field helpers shared by the report card specs: functions of a trial's row
+# giving the text or the url of a field (see TABLE)
+
+
+# Function to build the link to the registry (CT.gov or DRKS)
+def gen_registry_url(row):
+    registry = row['registry']
+    if registry == "ClinicalTrials.gov":
+        url = "https://clinicaltrials.gov/ct2/show/" + row['id']
+    elif registry == "DRKS":
+        url = "https://www.drks.de/drks_web/navigate.do?navigationId=trial.HTML&TRIAL_ID=" + row['id']
+    else:
+        raise RuntimeError(f"Unknown registry {registry}")
+    return url
+
+
+def url_for_publication(row):
+    url = row["url"]
+
+    if pd.isna(url):
+        url = ""
+    return url
+
+
+def url_for_improve_sumres(row):
+    registry = row['registry']
+    if registry == "ClinicalTrials.gov":
+        url = "https://clinicaltrials.gov/ct2/manage-recs/how-report"
+    elif registry == "DRKS":
+        url = "https://www.drks.de/drks_web/navigate.do?navigationId=edit&messageDE=Studien%20registrieren&messageEN=Register%20trials"
+    else:
+        raise RuntimeError(f"Unknown registry {registry}")
+    return url
+
+
+def url_for_improve_link(row):
+    registry = row['registry']
+    if registry == "ClinicalTrials.gov":
+        url = "https://prsinfo.clinicaltrials.gov/tutorial/content/index.html#/lessons/GE_igGejMjFu9WtErAxXw9-qdeUggVBX"
+    elif registry == "DRKS":
+        url = "https://www.drks.de/drks_web/navigate.do?navigationId=edit&messageDE=Studien%20registrieren&messageEN=Register%20trials"
+    else:
+        raise RuntimeError(f"Unknown registry {registry}")
+    return url
+
+
+def url_for_library(_row):
+    url = "https://bibliothek.charite.de/en/publishing/open_access/the_green_route_to_open_access/"
+    return url
+
+
+def url_for_euctr_crossreg(row):
+    url = "https://www.clinicaltrialsregister.eu/ctr-search/search?query=" + row['trn_eudract']
+
+    if pd.isna(url):
+        url = ""
+    return url
+
+
+def id_for_publication(row):
+    return row["id"]
+
+
+def get_days_reg_to_start(row):
+    days_reg_to_start = row['days_reg_to_start']
+    if pd.isna(days_reg_to_start):
+        return "N/A"
+    return abs(days_reg_to_start)
+
+
+def get_start_date(row):
+    return schema.format_date(row['start_date'])
+
+
+def get_completion_date(row):
+    return schema.format_date(row['completion_date'])
+
+
+def get_euctr_trn(row):
+    return row["trn_eudract"]
+
+
+def get_trn(row):
+    return "'" + row["id"] + "'"
+
+
+def gen_core_facility_email(_row):
+    email = "mailto:studienergebnisse@charite.de"
+    return email
@@ -0,0 +1,136 @@
+import glob
+import json
+import os
+
+from .manifest import file_digest
+
+
+# Function to name the file an output is written to before it is renamed
+# into place, in the same directory (so the rename is atomic) and with the
+# same extension (which converters such as Inkscape go by)
+def partial_path(path):
+    directory, name = os.path.split(path)
+    base, extension = os.path.splitext(name)
+    return os.path.join(directory, f".{base}.part{extension}")
+
+
+# Function to remove the partial files an interrupted run left in a
+# directory, only of the cards `owned(name)` accepts when given (other
+# shards may be writing to the same directory); returns how many there were
+def remove_partial(directory, owned=None):
+    removed = 0
+    for path in glob.glob(os.path.join(directory, ".*.part.*")):
+        name = os.path.basename(path)[1:].rsplit(".part.", 1)[0]
+        if owned is not None and not owned(name):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+    return removed
+
+
+# Function to name the journal kept next to a manifest
+def journal_path(manifest_path):
+    return os.path.splitext(manifest_path)[0] + ".journal.jsonl"
+
+
+class Journal:
+    """Append-only log of the cards completed during a run.
+
+    The manifest is only saved at the end of a run; if the process is
+    killed (e.g. the machine is pre-empted) the journal still tells which
+    cards were finished. Every line records one card with the sha256 of
+    each of its output files and goes to disk before the next card is
+    recorded, so at most the last line can be cut short. Each worker
+    appends with a single write, so several can share one journal. When
+    the journal was removed (see remove_journal) since the last card, it is
+    opened again, so that the next card is not appended to the removed file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = self._open()
+
+    def _open(self):
+        return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    # Function to check that the journal open is still the one at its path,
+    # and open that (creating it if needed) otherwise
+    def _reopen_if_removed(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        opened = os.fstat(self.fd)
+        if st is None or (st.st_dev, st.st_ino) != (opened.st_dev, opened.st_ino):
+            os.close(self.fd)
+            self.fd = self._open()
+
+    # Function to record a finished card; returns the checksums of its files
+    def record(self, name, key, files):
+        checksums = {os.path.basename(f): file_digest(f) for f in files}
+        line = json.dumps({"name": name, "key": key, "sha256": checksums}) + "\n"
+        self._reopen_if_removed()
+        os.write(self.fd, line.encode("utf-8"))
+        os.fsync(self.fd)
+        return checksums
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Function to remove a journal once the manifest holds everything recorded
+# in it (a Journal still open creates it again when it records the next card)
+def remove_journal(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Function to read the cards recorded in a journal, leaving out a last
+# line cut short by a crash
+def read_journal(path):
+    records = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+    except FileNotFoundError:
+        pass
+    return records
+
+
+# Function to bring a manifest up to date with the journal of an earlier,
+# interrupted run: cards whose files all still match their checksums are
+# taken over, the others are forgotten (and their files removed) so that
+# they are rendered again. Returns the number of cards recovered and
+# repaired.
+def recover(built, path, directory):
+    recovered = repaired = 0
+    for record in read_journal(path):
+        name = record["name"]
+        card_dir = os.path.join(directory, os.path.dirname(name))
+        files = [os.path.join(card_dir, f) for f in record["sha256"]]
+        if all(_matches(f, checksum) for f, checksum in zip(files, record["sha256"].values())):
+            built.record(name, record["key"], files, record["sha256"])
+            recovered += 1
+        else:
+            built.forget(name)
+            for f in files:
+                if os.path.exists(f):
+                    os.remove(f)
+            repaired += 1
+    return recovered, repaired
+
+
+def _matches(path, checksum):
+    try:
+        return file_digest(path) == checksum
+    except FileNotFoundError:
+        return False
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+
+
+MANIFEST_NAME = ".report-cards-manifest.json"
+
+
+# Function to hash the content of one or more files
+def file_digest(*paths):
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# Function to hash the code that renders the cards: the calling script and
+# the reportcards package (card specs included), so that any change to
+# either invalidates cards
+def code_digest(script):
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    sources = []
+    for directory, _, files in os.walk(package_dir):
+        sources.extend(os.path.join(directory, f) for f in files if f.endswith(".py"))
+    return file_digest(script, *sorted(sources))
+
+
+# Function to build the key of one card from everything its output depends on
+def card_key(*parts):
+    data = json.dumps(parts, default=str, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class Manifest:
+    """Which card was rendered from which inputs (by key), stored as JSON
+    next to the output so that reruns can skip unchanged cards."""
+
+    def __init__(self, path, entries=None):
+        self.path = path
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        return cls(path, entries)
+
+    # A card is current when it was built from the same key and all of its
+    # output files are still there (and, when verifying, still have the
+    # checksums recorded for them)
+    def is_current(self, name, key, files, verify=False):
+        entry = self.entries.get(name)
+        if entry is None or entry["key"] != key:
+            return False
+        if not all(os.path.exists(f) for f in files):
+            return False
+        checksums = entry.get("sha256")
+        if verify and checksums:
+            return all(checksums.get(os.path.basename(f)) == file_digest(f) for f in files)
+        return True
+
+    def record(self, name, key, files, checksums=None):
+        self.entries[name] = {"key": key, "files": [os.path.basename(f) for f in files]}
+        if checksums:
+            self.entries[name]["sha256"] = checksums
+
+    def forget(self, name):
+        self.entries.pop(name, None)
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
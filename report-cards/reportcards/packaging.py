@@ -0,0 +1,312 @@
+import collections
+import csv
+import hashlib
+import io
+import os
+import sys
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, StreamObject
+
+
+# Function to list the PDFs going into one trialist's package, in order:
+# the invitation letter, their report cards and the info sheet
+def package_sources(row, letters_dir, reports_dir, infosheet):
+    name = row['name_for_file']
+    sources = [os.path.join(letters_dir, f"{name}.pdf")]
+    for trial in row['ids'].split(";"):
+        trial = trial.strip()
+        sources.append(os.path.join(reports_dir, f"{trial}.pdf"))
+    sources.append(infosheet)
+    return sources
+
+
+# Function to check all sources before any package is built
+def find_missing(sources):
+    return sorted({path for path in sources if not os.path.exists(path)})
+
+
+class PdfCache:
+    """Parsed PDFs by path, so that a report card shared by several
+    trialists is read from disk and parsed once. Keeps the `size` most
+    recently used files."""
+
+    def __init__(self, size=256):
+        self.size = size
+        self.readers = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def pages(self, path):
+        reader = self.readers.get(path)
+        if reader is None:
+            self.misses += 1
+            reader = PdfReader(path)
+            self.readers[path] = reader
+            if len(self.readers) > self.size:
+                self.readers.popitem(last=False)
+        else:
+            self.hits += 1
+            self.readers.move_to_end(path)
+        return reader.pages
+
+
+# Kinds of page resources shared across the pages of a package: images by
+# default, and with `optimize` everything that can be (fonts included)
+IMAGES = ("/XObject",)
+ALL_RESOURCES = ("/XObject", "/Font", "/ExtGState", "/ColorSpace", "/Pattern", "/Shading")
+
+
+class SharedResources:
+    """Adds pages to a PdfWriter so that identical resources are stored once.
+
+    Every report card embeds the same logos (and often the same font
+    subsets), and pypdf copies the resources of each source PDF into the
+    package separately. Before a page is added, its resources of the given
+    `categories` that are identical (same content and parameters) to one
+    already in the package are pointed at that copy instead; the source
+    page is restored afterwards, as it may be shared with other packages.
+    """
+
+    def __init__(self, writer, categories=IMAGES):
+        self.writer = writer
+        self.categories = categories
+        self.shared = {}
+        self._digests = {}
+        self.reused = 0
+
+    def add_page(self, page):
+        swapped = []
+        fresh = []
+        for category in self.categories:
+            resources = _resources(page, category)
+            for name, ref in list(resources.items()):
+                if not isinstance(ref, IndirectObject):
+                    continue
+                digest = self._digest(ref)
+                if digest is None:
+                    continue
+                if digest in self.shared:
+                    swapped.append((resources, name, ref))
+                    resources[NameObject(name)] = self.shared[digest]
+                    self.reused += 1
+                else:
+                    fresh.append((category, name, digest))
+
+        try:
+            added = self.writer.add_page(page)
+        finally:
+            for resources, name, ref in swapped:
+                resources[NameObject(name)] = ref
+
+        for category, name, digest in fresh:
+            self.shared.setdefault(digest, _resources(added, category).raw_get(name))
+        return added
+
+    # Function to hash an object of a source PDF with everything it refers
+    # to; None for objects that refer back to themselves, which are not
+    # shared
+    def _digest(self, ref):
+        key = (id(ref.pdf), ref.idnum, ref.generation)
+        if key in self._digests:
+            return self._digests[key]
+        self._digests[key] = None
+        h = hashlib.sha256()
+        if not self._update(h, ref.get_object()):
+            return None
+        digest = self._digests[key] = h.hexdigest()
+        return digest
+
+    def _update(self, h, obj):
+        if isinstance(obj, IndirectObject):
+            digest = self._digest(obj)
+            if digest is None:
+                return False
+            h.update(b"R" + digest.encode("ascii"))
+        elif isinstance(obj, DictionaryObject):
+            h.update(b"<<")
+            for key in sorted(obj):
+                if key == "/Length":
+                    continue
+                h.update(key.encode("utf-8"))
+                if not self._update(h, obj.raw_get(key)):
+                    return False
+            h.update(b">>")
+            if isinstance(obj, StreamObject):
+                # The encoded data: equal filters were hashed above, and
+                # decoding every image just to compare it would be slow
+                h.update(obj._data)
+        elif isinstance(obj, ArrayObject):
+            h.update(b"[")
+            for item in obj:
+                if not self._update(h, item):
+                    return False
+            h.update(b"]")
+        else:
+            h.update(repr(obj).encode("utf-8") + b" ")
+        return True
+
+
+# Function to get the resources of one category (e.g. /XObject) of a page
+# (empty if it has none)
+def _resources(page, category):
+    resources = page.get("/Resources")
+    if resources is None:
+        return DictionaryObject()
+    return resources.get_object().get(category, DictionaryObject()).get_object()
+
+
+# Function to estimate the size of a file once attached to an email:
+# base64 encoded, with a line break every 76 characters
+def mail_size(size):
+    encoded = (size + 2) // 3 * 4
+    return encoded + (encoded + 75) // 76 * 2
+
+
+# Function to merge the pages of `sources` into `outfile` in process,
+# storing images shared by several pages (e.g. the logos of every report
+# card) once. With `optimize`, all identical resources (fonts included) are
+# shared and content streams left uncompressed are compressed. Sources are
+# paths (read through the cache) or already parsed PdfReaders.
+def merge(sources, outfile, cache, optimize=False):
+    writer = PdfWriter()
+    pages = SharedResources(writer, ALL_RESOURCES if optimize else IMAGES)
+    for source in sources:
+        for page in (source.pages if isinstance(source, PdfReader) else cache.pages(source)):
+            added = pages.add_page(page)
+            if optimize:
+                _compress_contents(added)
+    # Renamed into place once complete, so no package is left half-written
+    tmp = outfile + ".tmp"
+    with open(tmp, "wb") as f:
+        writer.write(f)
+    os.replace(tmp, outfile)
+
+
+# Function to compress the content streams of a page that have no filter
+def _compress_contents(page):
+    contents = page.get("/Contents")
+    if contents is None:
+        return
+    streams = contents if isinstance(contents, ArrayObject) else [contents]
+    if all("/Filter" in stream.get_object() for stream in streams):
+        return
+    page.compress_content_streams()
+
+
+# Function to list the size of every package: on disk and once attached to
+# an email, against the `limit` (in bytes) of the mail servers. Writes the
+# list to `path` (.csv) if given.
+def size_report(names, outdir, limit, path=None):
+    rows = []
+    for name in names:
+        size = os.path.getsize(os.path.join(outdir, f"{name}.pdf"))
+        rows.append({"name": name, "bytes": size, "mail_bytes": mail_size(size),
+                     "over_limit": mail_size(size) > limit})
+
+    if path:
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["name", "bytes", "mail_bytes", "over_limit"])
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+def print_size_report(rows, limit, out=sys.stderr):
+    if not rows:
+        return
+    total = sum(row["bytes"] for row in rows)
+    largest = max(rows, key=lambda row: row["bytes"])
+    print(f"Packages: {total / 1024 ** 2:.1f} MB in total, largest {largest['name']} "
+          f"({largest['bytes'] / 1024 ** 2:.1f} MB)", file=out)
+    over = [row for row in rows if row["over_limit"]]
+    if not over:
+        return
+    print(f"{len(over)} over the mail size limit of {limit / 1024 ** 2:g} MB "
+          f"(size once attached):", file=out)
+    for row in sorted(over, key=lambda row: -row["mail_bytes"]):
+        print(f"  {row['name']}: {row['mail_bytes'] / 1024 ** 2:.1f} MB", file=out)
+
+
+# Function to read the trialists' packages from the email parameters as
+# (name_for_file, [trial ids]) pairs
+def read_packages(data):
+    return [(row['name_for_file'], [trial.strip() for trial in row['ids'].split(";")])
+            for row in data.to_dict("records")]
+
+
+class PackageAssembler:
+    """Builds the packages from report cards rendered in memory.
+
+    Cards are handed over as PDF bytes as they are rendered and parsed
+    once; a package is written as soon as all of its cards are in, and a
+    card is dropped once every package listing it is done.
+    """
+
+    def __init__(self, packages, letters_dir, infosheet, outdir, cache=None):
+        self.letters_dir = letters_dir
+        self.infosheet = infosheet
+        self.outdir = outdir
+        self.cache = cache or PdfCache()
+        self.packages = dict(packages)
+        self.waiting = {name: set(trials) for name, trials in packages}
+        # Packages listing each trial, and how many of them are not done
+        self.users = collections.defaultdict(set)
+        self.refs = collections.Counter()
+        for name, trials in packages:
+            for trial in set(trials):
+                self.users[trial].add(name)
+                self.refs[trial] += 1
+        self.cards = {}
+
+    # Function to hand over one rendered card (or its error); returns the
+    # (package, error) results of the packages this completes
+    def add(self, trial, pdf=None, error=None):
+        if error is None and self.refs[trial] > 0:
+            try:
+                self.cards[trial] = PdfReader(io.BytesIO(pdf))
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+
+        results = []
+        for name in sorted(self.users.pop(trial, ())):
+            if name not in self.waiting:
+                continue  # already failed because of another card
+            if error is not None:
+                results.append((name, f"report card {trial} failed: {error}"))
+                self._done(name)
+                continue
+            self.waiting[name].discard(trial)
+            if not self.waiting[name]:
+                results.append((name, self._build(name)))
+                self._done(name)
+        return results
+
+    # Function to fail the packages still waiting, e.g. for trials that are
+    # not in the data at all
+    def finish(self):
+        results = []
+        for name in sorted(self.waiting):
+            trials = ", ".join(sorted(self.waiting[name]))
+            results.append((name, f"report cards never rendered: {trials}"))
+        self.waiting.clear()
+        self.cards.clear()
+        return results
+
+    def _build(self, name):
+        sources = ([os.path.join(self.letters_dir, f"{name}.pdf")]
+                   + [self.cards[trial] for trial in self.packages[name]]
+                   + [self.infosheet])
+        try:
+            merge(sources, os.path.join(self.outdir, f"{name}.pdf"), self.cache)
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+        return None
+
+    # Function to mark a package as done and drop the cards nothing needs
+    def _done(self, name):
+        del self.waiting[name]
+        for trial in set(self.packages[name]):
+            self.refs[trial] -= 1
+            if self.refs[trial] == 0:
+                self.cards.pop(trial, None)
@@ -0,0 +1,69 @@
+import collections
+import concurrent.futures
+import sys
+
+
+# Function to split a DataFrame into roughly equal chunks of rows
+def split_rows(data, n_chunks):
+    n_chunks = max(1, min(n_chunks, len(data)))
+    size, extra = divmod(len(data), n_chunks)
+    chunks = []
+    start = 0
+    for i in range(n_chunks):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(data.iloc[start:end])
+        start = end
+    return chunks
+
+
+# Function to run `fn` over every chunk, in this process when jobs == 1 or
+# over a pool of worker processes otherwise. Each call of `fn` returns a
+# list of (name, error) tuples; these are yielded in input order.
+# Chunks are taken from `chunks` lazily, with at most `max_pending` of them
+# (default: two per worker) in flight, so `chunks` may be a stream.
+def run_chunks(fn, chunks, jobs=1, initializer=None, initargs=(), max_pending=None):
+    if jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for chunk in chunks:
+            yield from fn(chunk)
+        return
+
+    max_pending = max_pending or jobs * 2
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=initializer, initargs=initargs) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.submit(fn, chunk))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+# Function to print progress as results come in and collect the failures.
+# Returns the failures and the number of results; `total` may be None when
+# it is not known up front (streaming).
+def report_progress(results, total=None, out=sys.stderr):
+    failures = []
+    count = 0
+    width = len(str(total))
+    for count, (name, error) in enumerate(results, start=1):
+        status = "ok" if error is None else "FAILED"
+        if total is None:
+            print(f"[{count}] {name} {status}", file=out)
+        else:
+            print(f"[{count:>{width}}/{total}] {name} {status}", file=out)
+        if error is not None:
+            failures.append((name, error))
+    return failures, count
+
+
+# Function to print the per-trial error summary at the end of a run
+def print_summary(failures, total, what="report cards rendered", out=sys.stderr):
+    print(f"{total - len(failures)} of {total} {what}", file=out)
+    if not failures:
+        return
+    print(f"{len(failures)} failed:", file=out)
+    for name, error in failures:
+        print(f"  {name}: {error}", file=out)
@@ -0,0 +1,132 @@
+import collections
+import cProfile
+import csv
+import glob
+import json
+import os
+import pstats
+import resource
+import sys
+
+from .timing import StageTimer
+
+
+# Function to read the peak resident set size of this process (and of the
+# processes it waited for, e.g. Inkscape) in MB
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux but in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return own, children
+
+
+class TrialProfiler:
+    """Times the stages of every trial rendered in this process.
+
+    Records are appended to a JSON lines file per process in `directory`
+    (flush after each chunk), so that the main process can put together
+    the results of all workers with `summarize`. With `cprofile`, a
+    cProfile of the process is kept next to them.
+    """
+
+    def __init__(self, directory, cprofile=False):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"trials-{os.getpid()}.jsonl")
+        self.records = []
+        self.profile = None
+        if cprofile:
+            self.cprofile_path = os.path.join(directory, f"cprofile-{os.getpid()}.prof")
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def start(self, name):
+        return StageTimer()
+
+    def finish(self, name, timer, error=None):
+        own, children = peak_rss_mb()
+        self.records.append({
+            "name": name,
+            "pid": os.getpid(),
+            "error": error,
+            "seconds": {stage: timer.totals[stage] for stage in timer.totals},
+            "events": dict(timer.events),
+            "peak_rss_mb": own,
+            "peak_rss_children_mb": children,
+        })
+
+    def flush(self):
+        with open(self.path, "a") as f:
+            for record in self.records:
+                f.write(json.dumps(record) + "\n")
+        self.records = []
+
+        if self.profile is not None:
+            # dump_stats stops the profiler, so it is restarted afterwards
+            self.profile.dump_stats(self.cprofile_path)
+            self.profile.enable()
+
+
+# Function to remove the records of an earlier run from `directory`
+def reset(directory):
+    for pattern in ("trials-*.jsonl", "cprofile*.prof"):
+        for path in glob.glob(os.path.join(directory, pattern)):
+            os.remove(path)
+
+
+# Function to combine the records of all processes: writes trials.csv (one
+# line per trial and stage), summary.json and, if there are cProfile dumps,
+# cprofile.prof (readable with pstats, snakeviz or flameprof)
+def summarize(directory):
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, "trials-*.jsonl"))):
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f)
+
+    stages = collections.defaultdict(float)
+    events = collections.Counter()
+    peaks = collections.defaultdict(lambda: (0, 0))
+    with open(os.path.join(directory, "trials.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "pid", "stage", "seconds"])
+        for record in records:
+            for stage, seconds in record["seconds"].items():
+                writer.writerow([record["name"], record["pid"], stage, f"{seconds:.6f}"])
+                stages[stage] += seconds
+            events.update(record["events"])
+            peaks[record["pid"]] = (max(peaks[record["pid"]][0], record["peak_rss_mb"]),
+                                    max(peaks[record["pid"]][1], record["peak_rss_children_mb"]))
+
+    summary = {
+        "trials": len(records),
+        "failed": sum(1 for record in records if record["error"]),
+        "seconds": dict(stages),
+        "events": dict(events),
+        "processes": len(peaks),
+        "peak_rss_mb": max((own for own, _ in peaks.values()), default=0),
+        "peak_rss_children_mb": max((children for _, children in peaks.values()), default=0),
+    }
+
+    dumps = sorted(glob.glob(os.path.join(directory, "cprofile-*.prof")))
+    if dumps:
+        stats = pstats.Stats(*dumps)
+        stats.dump_stats(os.path.join(directory, "cprofile.prof"))
+        summary["cprofile"] = os.path.join(directory, "cprofile.prof")
+
+    with open(os.path.join(directory, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=1)
+    return summary
+
+
+def print_summary(summary, out=sys.stderr):
+    print(f"Profile of {summary['trials']} trials over {summary['processes']} process(es):", file=out)
+    total = sum(summary["seconds"].values()) or 1
+    for stage, seconds in sorted(summary["seconds"].items(), key=lambda item: -item[1]):
+        per_trial = seconds / max(summary["trials"], 1) * 1000
+        print(f"  {stage:<10} {seconds:9.3f}s  {seconds / total:6.1%}  {per_trial:8.3f}ms/trial", file=out)
+    for name, count in sorted(summary["events"].items()):
+        print(f"  {name}: {count}", file=out)
+    print(f"  peak RSS: {summary['peak_rss_mb']:.0f} MB per worker, "
+          f"{summary['peak_rss_children_mb']:.0f} MB for subprocesses", file=out)
+    if "cprofile" in summary:
+        print(f"  cProfile: {summary['cprofile']}", file=out)
@@ -0,0 +1,228 @@
+import pandas as pd
+from lxml import etree
+
+from . import schema
+from .decision import DecisionTable
+from .fields import gen_registry_url
+from .template import CompiledTemplate, XLINK_NS, serialize, write_svg
+from .timing import NULL_TIMER
+
+
+# Function to add hyperlinks
+def linkify(node, target):
+    link = etree.Element("a")
+    link.attrib[f"{{{XLINK_NS}}}href"] = target
+    link.attrib["target"] = "_blank"
+
+    parent = node.getparent()
+    # Insert hyperlink anchors at the right level (where node comes from)
+    parent.insert(parent.index(node), link)
+    parent.remove(node)
+
+    # Insert content of link
+    link.insert(0, node)
+
+
+# Function to find the element holding the text of a field: the element
+# itself, or the first child of a group
+def get_element(card, id_name, section_type="g"):
+    result = card.find(id_name, section_type)
+
+    if result is None:
+        return None
+
+    if section_type == "g":
+        node = result.getchildren()[0]
+    else:
+        node = result
+
+    return node
+
+
+# Function to replace text
+def replace(card, section_type, id_name, text=None, target=None):
+    node = get_element(card, id_name, section_type)
+    if node is None:
+        print(f"WARNING: {id_name} field does not exist")
+        return
+
+    if text is not None:
+        node.text = str(text)
+
+    if not target:
+        return
+
+    linkify(node, target)
+
+
+# Function to select and delete layers
+def remove_layers(card, layers_to_exclude):
+    card.remove(layers_to_exclude)
+
+
+# Function to build layer names in a specific module (e.g., registration)
+def gen_layer(desc):
+    result = []
+    name = desc["name"]
+    number = desc["number"]
+    for i in range(number):
+        result.append(f"{name}_layer_{i+1}")
+    if desc["na"]:
+        result.append(f"{name}_layer_na")
+    return set(result)
+
+
+# Function to combine all layers across all modules
+def get_all_layers(layers):
+    all_layers = set()
+    for layer in layers:
+        all_layers.update(gen_layer(layer))
+    return all_layers
+
+
+# Function to build a post-processing hook (see TABLE "post") that indents
+# a field by `num` spaces on DRKS cards
+def spacify(name, num=3):
+    def fn(card, row):
+        if row["registry"] != "DRKS":
+            return
+
+        node = get_element(card, name)
+        if node is None:
+            print(f"WARNING {name} not found")
+            return
+        node.text = " "*num + node.text
+    return fn
+
+
+class CardSpec:
+    """What goes on one kind of report card.
+
+    `table` is the decision tree choosing the layer of every module and
+    the fields to fill in (see DecisionTable), `layers` lists the layers of
+    each module (see gen_layer). The header holds the TRN (followed by
+    `trn_suffix`) and the title, cut after `title_cutoff` characters;
+    fields are elements of type `field_type` ("g" for a group whose first
+    child holds the text).
+    """
+
+    def __init__(self, table, layers, title_cutoff=105, trn_suffix=":", field_type="g"):
+        self.table = table
+        self.layers = layers
+        self.title_cutoff = title_cutoff
+        self.trn_suffix = trn_suffix
+        self.field_type = field_type
+        self.decision = DecisionTable(table)
+        self.all_layers = get_all_layers(layers)
+
+    # Function to list the layers and fields of this kind of card that a
+    # compiled template does not have, e.g. one made for another kind
+    def missing(self, template):
+        ids = [(layer, None) for layer in sorted(self.all_layers)]
+        ids += [("TRN", self.field_type), ("title", self.field_type)]
+        for _, leaves in self.decision.modules:
+            for _, element in leaves:
+                ids.extend((v["id"], self.field_type) for k, v in element.items() if k != "layer")
+
+        missing = []
+        for id_name, section_type in ids:
+            if not template.has(id_name, section_type) and id_name not in missing:
+                missing.append(id_name)
+        return missing
+
+
+class Renderer:
+    """Renders the cards of a CardSpec from one template, in process.
+
+    The compiled template (and the pruned copy for every combination of
+    layers) is kept between calls, so that once warm a single card takes
+    milliseconds:
+
+        renderer = Renderer(merged.SPEC, "report-card-merged.svg")
+        svg = renderer.render(row)
+
+    `row` is a mapping with the columns of the trial (e.g. a dict or a
+    DataFrame row, typed by schema.load_trials or not). Its assignment (see
+    DecisionTable.assign) is computed when not given, from the row typed
+    as load_trials would; pass it in when rendering many trials, as
+    assigning a whole typed DataFrame at once is much faster. With an AssetStore, the
+    template's images are referenced from the store instead of embedded.
+    """
+
+    def __init__(self, spec, template, cache_dir=None, assets=None):
+        if not isinstance(template, CompiledTemplate):
+            template = CompiledTemplate.load(template, cache_dir=cache_dir, assets=assets)
+        self.spec = spec
+        self.template = template
+
+    # Function to select the layers and fields of a single trial, typed as
+    # schema.load_trials reads the data first
+    def assign(self, row):
+        data = schema.coerce(pd.DataFrame([dict(row)]))
+        return self.spec.decision.assign(data).iloc[0].to_dict()
+
+    # Function to fill in the card of one trial; returns the Card
+    def fill(self, row, assignment=None, timer=NULL_TIMER):
+        if assignment is None:
+            assignment = self.assign(row)
+        if assignment["error"]:
+            raise RuntimeError(assignment["error"])
+
+        spec = self.spec
+        template = self.template
+
+        # Define which layers need to be excluded for this trial
+        included_layers = {assignment[module] for module, _ in spec.decision.modules}
+        layers_to_exclude = spec.all_layers - included_layers
+
+        # Use base XML content on each run, leaving out the excluded layers
+        # (the template is pruned once per combination of layers)
+        hits, misses = template.variant_hits, template.variant_misses
+        with timer.stage("copy"):
+            card = template.instantiate(layers_to_exclude)
+        timer.count("variants_built", template.variant_misses - misses)
+        timer.count("variants_reused", template.variant_hits - hits)
+
+        with timer.stage("edit"):
+            # Add trial registration number
+            replace(card, spec.field_type, "TRN", row['id'] + spec.trn_suffix,
+                    gen_registry_url(row))
+            # Add title of trial
+            title = row['title']
+            if len(title) > spec.title_cutoff:
+                title = title[0:spec.title_cutoff] + "…"
+            replace(card, spec.field_type, "title", title)
+
+            for the_id, text, url in assignment["fields"]:
+                replace(card, spec.field_type, the_id, text, url)
+
+                post = spec.decision.posts.get(the_id)
+                if post:
+                    post(card, row)
+
+            # Check that every excluded layer exists in the template
+            remove_layers(card, layers_to_exclude)
+
+        timer.count("lookups", card.lookups)
+        return card
+
+    # Function to render the SVG of one trial in memory
+    def render(self, row, assignment=None, svg_format="pretty", timer=NULL_TIMER):
+        card = self.fill(row, assignment, timer)
+
+        # objectify.deannotate(root)
+        # etree.cleanup_namespaces(root)
+        with timer.stage("serialize"):
+            return serialize(card.root, svg_format)
+
+    # Function to render the SVG of one trial straight into a file
+    def write(self, row, path, assignment=None, svg_format="pretty", timer=NULL_TIMER):
+        card = self.fill(row, assignment, timer)
+        with timer.stage("write"):
+            write_svg(card.root, path, svg_format)
+
+    # Function to render one trial to PDF bytes with a converter
+    def render_pdf(self, row, converter, assignment=None, timer=NULL_TIMER):
+        svg = self.render(row, assignment, timer=timer)
+        with timer.stage("convert"):
+            return converter.convert_to_bytes(svg)
@@ -0,0 +1,133 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+
+
+class SubprocessError(Exception):
+    pass
+
+
+class SubprocessScheduler:
+    """Runs external commands (Inkscape, pdfunite) from an asyncio event loop
+    in a background thread, so that the caller keeps doing XML work while
+    they run.
+
+    At most `concurrency` commands run at the same time. A command that
+    fails, does not finish within `timeout` seconds or does not write its
+    `output` file is killed and retried up to `retries` times, waiting
+    `retry_delay` seconds (doubling) in between. `submit` blocks while
+    `max_pending` commands are queued or running, so a slow converter
+    holds the producer back instead of piling up work.
+    """
+
+    def __init__(self, concurrency=1, timeout=120, retries=1, retry_delay=1.0, max_pending=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pending = threading.BoundedSemaphore(max_pending or concurrency * 2)
+        self.calls = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.running = asyncio.run_coroutine_threadsafe(self._semaphore(), self.loop).result()
+
+    async def _semaphore(self):
+        return asyncio.Semaphore(self.concurrency)
+
+    # Function to queue a command; returns a concurrent.futures.Future
+    def submit(self, cmd, output=None):
+        self.pending.acquire()
+        future = asyncio.run_coroutine_threadsafe(self.run(cmd, output), self.loop)
+        future.add_done_callback(lambda _: self.pending.release())
+        return future
+
+    async def run(self, cmd, output=None):
+        async with self.running:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+                error = await self._run_once(cmd, output)
+                if error is None:
+                    return
+        raise SubprocessError(f"{os.path.basename(cmd[0])} {error} "
+                              f"(tried {self.retries + 1} times)")
+
+    async def _run_once(self, cmd, output):
+        # Remove any stale output so a failed run cannot go unnoticed
+        if output and os.path.exists(output):
+            os.remove(output)
+
+        self.calls += 1
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return f"did not finish within {self.timeout}s"
+
+        if process.returncode != 0:
+            message = stderr.decode("utf-8", "replace").strip().splitlines()
+            return f"exited with {process.returncode}" + (f": {message[-1]}" if message else "")
+        if output and (not os.path.exists(output) or os.path.getsize(output) == 0):
+            return f"did not write {output}"
+        return None
+
+    # Function to wait for every queued command and stop the event loop
+    def close(self):
+        if not self.loop.is_running():
+            return
+        asyncio.run_coroutine_threadsafe(self._drain(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _drain(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Function to wrap the outcome of work done right away as a Future, so that
+# callers can treat it like a submitted command
+def completed(fn, *args):
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+# Function to wrap an error as a failed Future
+def failed(error):
+    future = concurrent.futures.Future()
+    future.set_exception(error)
+    return future
+
+
+# Function to run `fn` once `future` succeeded; returns a Future that is
+# done when `fn` is (failing if either of them failed)
+def then(future, fn, *args):
+    chained = concurrent.futures.Future()
+
+    def run(done):
+        if done.exception() is not None:
+            chained.set_exception(done.exception())
+            return
+        try:
+            chained.set_result(fn(*args))
+        except Exception as e:
+            chained.set_exception(e)
+    future.add_done_callback(run)
+    return chained
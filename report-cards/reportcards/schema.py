@@ -0,0 +1,127 @@
+import os
+
+import pandas as pd
+
+from .manifest import file_digest
+
+
+# Bump when the columns or dtypes below change, so cached copies are rebuilt
+SCHEMA_VERSION = 3
+
+# The columns of trackvalue-checked.csv the report card uses, with their dtypes.
+# Flags are nullable booleans (missing = NA), dates are parsed separately.
+COLUMNS = {
+    "id": "string",
+    # Not a categorical: values outside a fixed list would become NA, and
+    # the fields have to report an unknown registry by name
+    "registry": "string",
+    "title": "string",
+    "url": "string",
+    "citation": "string",
+    # Only on the classic card
+    "pub_title": "string",
+    "doi": "string",
+    "trn_eudract": "string",
+    "days_reg_to_start": "Int64",
+    "has_publication": "boolean",
+    "is_oa": "boolean",
+    "is_closed_archivable": "boolean",
+    "has_summary_results": "boolean",
+    "is_summary_results_1y": "boolean",
+    "is_publication_2y": "boolean",
+    "has_iv_trn_abstract": "boolean",
+    "has_iv_trn_ft": "boolean",
+    "has_reg_pub_link": "boolean",
+    "is_prospective": "boolean",
+    "days_reg_to_start_is_positive": "boolean",
+    "has_valid_crossreg_eudract": "boolean",
+    "is_prospective_eudract": "boolean",
+    "has_summary_results_eudract": "boolean",
+}
+
+DATE_COLUMNS = ["start_date", "completion_date"]
+BOOLEANS = {"TRUE": True, "True": True, "FALSE": False, "False": False}
+DATE_FORMAT = "%Y-%m-%d"
+
+
+# Function to read only the columns the report card needs, with declared
+# dtypes. With a cache dir (and pyarrow installed) the typed table is kept
+# as Parquet, keyed on the content of the CSV, and reused on the next run.
+# With a chunksize, an iterator over DataFrames of at most that many rows
+# is returned instead, so the file is never held in memory as a whole.
+def load_trials(path, cache_dir=None, chunksize=None):
+    if chunksize:
+        return (_parse_dates(chunk) for chunk in _read_csv(path, chunksize=chunksize))
+
+    cache_file = None
+    if cache_dir and _has_parquet():
+        cache_file = os.path.join(cache_dir, f"{file_digest(path)}.v{SCHEMA_VERSION}.parquet")
+        if os.path.exists(cache_file):
+            return pd.read_parquet(cache_file)
+
+    data = _parse_dates(_read_csv(path))
+
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = cache_file + ".tmp"
+        data.to_parquet(tmp)
+        os.replace(tmp, cache_file)
+
+    return data
+
+
+# Function to give a table read as text (see sources.py) the columns and
+# dtypes load_trials reads (in the order of the table, like read_csv)
+def typed(data):
+    missing = [column for column in list(COLUMNS) + DATE_COLUMNS if column not in data]
+    if missing:
+        raise ValueError(f"the data has no column {', '.join(missing)}")
+    data = data[[column for column in data.columns if column in COLUMNS or column in DATE_COLUMNS]].copy()
+    return coerce(data)
+
+
+# Function to give the columns of `data` that load_trials reads its dtypes,
+# whether they hold text (see typed) or values as pandas' read_csv or a
+# caller guessed them (e.g. floats for whole numbers, dates as text)
+def coerce(data):
+    for column, dtype in COLUMNS.items():
+        if column not in data:
+            continue
+        if dtype == "boolean":
+            data[column] = data[column].map(lambda v: BOOLEANS.get(v, v) if isinstance(v, str) else v,
+                                            na_action="ignore").astype("boolean")
+        elif dtype == "Int64":
+            data[column] = pd.to_numeric(data[column]).astype("Int64")
+        else:
+            data[column] = data[column].astype(dtype)
+    for column in DATE_COLUMNS:
+        if column in data and not pd.api.types.is_datetime64_any_dtype(data[column]):
+            data[column] = pd.to_datetime(data[column], format=DATE_FORMAT)
+    return data
+
+
+def _read_csv(path, **kwargs):
+    return pd.read_csv(path, usecols=list(COLUMNS) + DATE_COLUMNS, dtype=COLUMNS,
+                       true_values=[k for k, v in BOOLEANS.items() if v],
+                       false_values=[k for k, v in BOOLEANS.items() if not v], **kwargs)
+
+
+def _parse_dates(data):
+    for column in DATE_COLUMNS:
+        data[column] = pd.to_datetime(data[column], format=DATE_FORMAT)
+    return data
+
+
+# Function to format a date column value the way it appears in the CSV
+def format_date(value):
+    if pd.isna(value):
+        return "N/A"
+    return value.strftime(DATE_FORMAT)
+
+
+def _has_parquet():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
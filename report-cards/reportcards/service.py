@@ -0,0 +1,270 @@
+import collections
+import gzip
+import http.server
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+from . import manifest, schema
+from .render import Renderer
+
+
+# Content types of the formats a card can be requested in
+CONTENT_TYPES = {
+    "svg": "image/svg+xml",
+    "svgz": "image/svg+xml",
+    "pdf": "application/pdf",
+}
+
+
+class CardService:
+    """Renders report cards on demand from a warm template and data set.
+
+    The template (with its index and pruned variants), the decision table
+    and the trials, indexed by TRN with their assignment, stay in memory
+    between requests. Both files are checked for changes (by size and
+    modification time) on every request and reloaded when they changed; a
+    version that cannot be loaded is reported and the previous one kept.
+    Rendered cards are kept in a least recently used cache of `max_cached`
+    entries under the key of their inputs, so that after a reload only the
+    cards of trials that actually changed are rendered again.
+
+    The renderer and the converter are not thread-safe, so cards are
+    rendered one at a time; cached cards are served without waiting, also
+    while the files are being reloaded.
+    """
+
+    def __init__(self, spec, template_path, data_path, converter=None, cache_dir=None,
+                 max_cached=1024):
+        self.spec = spec
+        self.template_path = template_path
+        self.data_path = data_path
+        self.converter = converter
+        self.cache_dir = cache_dir
+        self.max_cached = max_cached
+
+        self.renderer = None
+        self.trials = {}
+        self.cache = collections.OrderedDict()
+        self.stats = collections.Counter()
+        self.loaded_at = None
+        self._stamps = {}
+        # Stamps of file versions that failed to load, not retried until
+        # the file changes again
+        self._failed = {}
+        self._lock = threading.Lock()
+        # Held while the files are checked and reloaded, by one thread at a time
+        self._reload_lock = threading.Lock()
+        self._render_lock = threading.Lock()
+        self.refresh()
+
+    # Function to reload the template and/or the data if their files
+    # changed; returns whether anything was reloaded. The files are loaded
+    # without holding the lock requests take and swapped in at the end, so
+    # that a reload never holds up requests; those arriving meanwhile (the
+    # reload lock is taken) are served from the previous version.
+    def refresh(self):
+        if not self._reload_lock.acquire(blocking=self.renderer is None):
+            return False
+        try:
+            loaded = {}
+            stamps = {}
+            failed = {}
+            for path, load in ((self.template_path, self._load_renderer),
+                               (self.data_path, self._load_trials)):
+                stamp = None
+                try:
+                    stamp = _stamp(path)
+                    if stamp == self._stamps.get(path) or stamp == self._failed.get(path):
+                        continue
+                    loaded[path] = load()
+                except Exception as e:
+                    # Nothing to fall back to when starting up
+                    if path not in self._stamps:
+                        raise
+                    # Keep serving the old version if the new one cannot be loaded
+                    print(f"Could not reload {path}, still serving the previous version: "
+                          f"{type(e).__name__}: {e}", file=sys.stderr)
+                    failed[path] = stamp
+                    continue
+                stamps[path] = stamp
+
+            with self._lock:
+                if self.template_path in loaded:
+                    self.renderer = loaded[self.template_path]
+                if self.data_path in loaded:
+                    self.trials = loaded[self.data_path]
+                self._stamps.update(stamps)
+                self._failed.update(failed)
+                for path in stamps:
+                    self._failed.pop(path, None)
+                self.stats["reload_errors"] += len(failed)
+                if loaded:
+                    self.loaded_at = time.time()
+                    self.stats["reloads"] += 1
+            return bool(loaded)
+        finally:
+            self._reload_lock.release()
+
+    def _load_renderer(self):
+        return Renderer(self.spec, self.template_path, self.cache_dir)
+
+    def _load_trials(self):
+        data = schema.load_trials(self.data_path, cache_dir=self.cache_dir)
+        assignments = self.spec.decision.assign(data)
+
+        trials = {}
+        for row, assignment in zip(data.to_dict("records"), assignments.to_dict("records")):
+            trials[row["id"]] = (row, assignment, self._trial_key(row, assignment))
+        return trials
+
+    # Function to key a trial on the values its card depends on, so cached
+    # cards survive a reload of the data unless their trial changed
+    def _trial_key(self, row, assignment):
+        return manifest.card_key(
+            [row["id"], row["title"], row["registry"]],
+            [assignment[module] for module, _ in self.spec.decision.modules],
+            assignment["fields"])
+
+    # Function to get the card of a trial in one of CONTENT_TYPES;
+    # returns None for an unknown TRN
+    def card(self, trn, fmt="svg"):
+        if fmt == "pdf" and self.converter is None:
+            raise ValueError("this service was started without a converter, PDFs are not available")
+        self.refresh()
+
+        with self._lock:
+            # The renderer and the trials that were swapped in together
+            renderer = self.renderer
+            trial = self.trials.get(trn)
+            if trial is None:
+                return None
+            row, assignment, trial_key = trial
+
+            key = (trn, fmt)
+            version = (renderer.template.digest, trial_key)
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] == version:
+                self.cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return cached[1]
+            self.stats["misses"] += 1
+
+        with self._render_lock:
+            body = self._render(renderer, row, assignment, fmt)
+
+        with self._lock:
+            self.cache[key] = (version, body)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+        return body
+
+    def _render(self, renderer, row, assignment, fmt):
+        if fmt == "svg":
+            return renderer.render(row, assignment)
+        if fmt == "svgz":
+            return gzip.compress(renderer.render(row, assignment, "compact"), 9)
+        return renderer.render_pdf(row, self.converter, assignment)
+
+    def status(self):
+        return {
+            "trials": len(self.trials),
+            "template": self.renderer.template.digest,
+            "variants_built": self.renderer.template.variant_misses,
+            "variants_reused": self.renderer.template.variant_hits,
+            "loaded_at": self.loaded_at,
+            "cached": len(self.cache),
+            **self.stats,
+        }
+
+    def close(self):
+        if self.converter is not None:
+            self.converter.close()
+
+
+# Function to identify the version of a file, to notice when it changed
+def _stamp(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class CardRequestHandler(http.server.BaseHTTPRequestHandler):
+    """GET /cards/<TRN>.<svg|svgz|pdf> returns a card, GET /status how the
+    service is doing."""
+
+    def do_GET(self):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        service = self.server.service
+
+        if path == "/status":
+            self._send(200, "application/json", json.dumps(service.status()).encode("utf-8"))
+            return
+
+        directory, _, filename = path.rpartition("/")
+        trn, _, fmt = filename.rpartition(".")
+        if directory != "/cards" or not trn or fmt not in CONTENT_TYPES:
+            self._error(404, "expected /cards/<TRN>.svg, .svgz or .pdf")
+            return
+
+        if fmt == "pdf" and service.converter is None:
+            self._error(404, "PDFs are not available, the service was started without a converter")
+            return
+
+        try:
+            body = service.card(trn, fmt)
+        except Exception as e:
+            self._error(500, f"could not render {trn}: {e}")
+            return
+        if body is None:
+            self._error(404, f"no trial {trn}")
+            return
+
+        self._send(200, CONTENT_TYPES[fmt], body,
+                   {"Content-Encoding": "gzip"} if fmt == "svgz" else {})
+
+    def _send(self, code, content_type, body, headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, code, message):
+        self._send(code, "text/plain; charset=utf-8", (message + "\n").encode("utf-8"))
+
+    # Unix socket clients have no address
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTPServer listening on a Unix socket instead of a TCP port."""
+
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+# Function to create the HTTP server for a CardService, on a TCP port or,
+# when `socket_path` is given, on a Unix socket
+def make_server(service, host="127.0.0.1", port=8000, socket_path=None):
+    if socket_path:
+        server = UnixHTTPServer(socket_path, CardRequestHandler)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), CardRequestHandler)
+    server.service = service
+    return server
@@ -0,0 +1,126 @@
+import argparse
+import collections
+import glob
+import hashlib
+import json
+import os
+import re
+
+from .manifest import MANIFEST_NAME, Manifest
+
+
+# Per-shard files in the output directory: the manifest of the cards the
+# shard rendered and its plan (the cards it is responsible for and the
+# inputs it rendered them from)
+SHARD_MANIFEST = ".report-cards-manifest.shard-{}-of-{}.json"
+SHARD_PLAN = ".report-cards-shard-{}-of-{}.json"
+
+
+# Function to parse a --shard argument, "i/N" for the i-th of N shards
+def parse_shard(value):
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if not match:
+        raise argparse.ArgumentTypeError(f"expected i/N (e.g. 2/8), not {value}")
+    i, n = int(match.group(1)), int(match.group(2))
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError(f"there is no shard {i} of {n}")
+    return i, n
+
+
+# Function to tell which of `shards` shards (counted from 1) a name belongs
+# to. Uses sha256 rather than hash(), which differs between processes, so
+# every machine partitions the same way.
+def shard_of(name, shards):
+    digest = hashlib.sha256(name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards + 1
+
+
+def owns(shard, name):
+    return shard is None or shard_of(name, shard[1]) == shard[0]
+
+
+# Function to keep the rows of `data` whose `column` belongs to the shard
+def select(data, column, shard):
+    if shard is None:
+        return data
+    return data[[owns(shard, name) for name in data[column]]]
+
+
+def manifest_path(outdir, shard=None):
+    if shard is None:
+        return os.path.join(outdir, MANIFEST_NAME)
+    return os.path.join(outdir, SHARD_MANIFEST.format(*shard))
+
+
+def save_plan(outdir, shard, cards, inputs):
+    path = os.path.join(outdir, SHARD_PLAN.format(*shard))
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"shard": shard[0], "shards": shard[1], "inputs": inputs,
+                   "cards": sorted(cards)}, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+# Function to record what a shard that builds packages (create-package.py,
+# or the generator with --packages) did, like the shards of cards: the
+# manifest of the packages built (keyed on what went into each) and the
+# plan, so that merge can check the shards of a packaging run as well
+def save_packages(outdir, shard, keys, built, inputs):
+    packages = Manifest(manifest_path(outdir, shard))
+    for name in built:
+        packages.record(name, keys[name], [os.path.join(outdir, f"{name}.pdf")])
+    packages.save()
+    save_plan(outdir, shard, keys, inputs)
+
+
+# Function to check the shards of a run in `outdir` and combine their
+# manifests into the manifest of the directory. Returns the problems found
+# as a dict of lists (empty when the run is complete).
+def merge(outdir):
+    plans = []
+    for path in sorted(glob.glob(os.path.join(outdir, SHARD_PLAN.format("*", "*")))):
+        with open(path) as f:
+            plans.append(json.load(f))
+
+    problems = collections.defaultdict(list)
+    if not plans:
+        return {"shards": ["no shards found"]}
+
+    counts = sorted({plan["shards"] for plan in plans})
+    if len(counts) > 1:
+        problems["shards"].append(f"shards of runs split {' and '.join(map(str, counts))} ways")
+    for n in counts:
+        seen = {plan["shard"] for plan in plans if plan["shards"] == n}
+        for i in range(1, n + 1):
+            if i not in seen:
+                problems["shards"].append(f"shard {i}/{n} is missing")
+
+    reference = plans[0]
+    for plan in plans[1:]:
+        for name, value in plan["inputs"].items():
+            if value != reference["inputs"].get(name):
+                problems["inputs"].append(f"shard {plan['shard']}/{plan['shards']} used a different "
+                                          f"{name} than shard {reference['shard']}/{reference['shards']}")
+
+    merged = Manifest(manifest_path(outdir))
+    planned = collections.Counter()
+    recorded = collections.Counter()
+    for plan in plans:
+        built = Manifest.load(manifest_path(outdir, (plan["shard"], plan["shards"])))
+        planned.update(plan["cards"])
+        recorded.update(list(built.entries))
+        for name in plan["cards"]:
+            entry = built.entries.get(name)
+            # Cards of several templates are in a subdirectory per template
+            directory = os.path.join(outdir, os.path.dirname(name))
+            if entry is None or not all(os.path.exists(os.path.join(directory, f))
+                                        for f in entry["files"]):
+                problems["missing"].append(name)
+                continue
+            merged.entries[name] = entry
+
+    problems["duplicates"] = sorted(name for name in planned | recorded
+                                    if planned[name] > 1 or recorded[name] > 1)
+    problems["missing"].sort()
+    merged.save()
+    return {kind: found for kind, found in problems.items() if found}
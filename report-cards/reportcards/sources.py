@@ -0,0 +1,151 @@
+import os
+
+import pandas as pd
+
+from . import schema
+from .manifest import card_key, file_digest
+
+
+# Bump when the way the sources are joined changes, so cached joins are rebuilt
+ASSEMBLY_VERSION = 1
+
+# Columns of trackvalue.csv that the checked cross-registrations replace
+DROPPED_PREFIXES = ("has_crossreg", "n_crossreg")
+
+
+# Function to read a source table as text, keeping every value as it is
+# written (missing values as NA), so that the assembled table can be
+# written out unchanged
+def read_source(path):
+    return pd.read_csv(path, dtype=str)
+
+
+# Function to assemble the table the report cards are rendered from (what
+# R/05_update-tv-manual-checks.R and R/06_correct-tv.R write to
+# trackvalue-checked.csv): trackvalue with the checked EUCTR
+# cross-registrations joined in by id, the OA checks applied by id and
+# doi, and the manual corrections (id, column, value) applied last.
+#
+# With a cache dir (and pyarrow installed) the join of trackvalue and the
+# cross-registrations is kept as Parquet, keyed on the content of both, so
+# that when only the OA checks or the corrections change the large tables
+# are not read again.
+def assemble(trackvalue, crossreg=None, oa_checks=None, corrections=None, cache_dir=None):
+    data = _joined(trackvalue, crossreg, cache_dir)
+    if oa_checks:
+        update_rows(data, read_source(oa_checks), ["id", "doi"], "OA checks")
+    if corrections:
+        correct(data, read_source(corrections))
+    return data
+
+
+def _joined(trackvalue, crossreg, cache_dir):
+    cache_file = None
+    if cache_dir and schema._has_parquet():
+        key = card_key(ASSEMBLY_VERSION, file_digest(trackvalue),
+                       file_digest(crossreg) if crossreg else None)
+        cache_file = os.path.join(cache_dir, f"{key}.joined.parquet")
+        if os.path.exists(cache_file):
+            return pd.read_parquet(cache_file)
+
+    data = join_crossreg(read_source(trackvalue), read_source(crossreg) if crossreg else None)
+
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = cache_file + ".tmp"
+        data.to_parquet(tmp)
+        os.replace(tmp, cache_file)
+
+    return data
+
+
+# Function to join the checked EUCTR cross-registrations into trackvalue
+# (a left join on id); trials without one have no valid cross-registration
+def join_crossreg(trackvalue, crossreg=None):
+    _check_unique(trackvalue, "trackvalue")
+    data = trackvalue[[column for column in trackvalue.columns
+                       if not column.startswith(DROPPED_PREFIXES)]].copy()
+
+    if crossreg is not None:
+        _check_unique(crossreg, "cross-registrations")
+        data = data.join(crossreg.set_index("id"), on="id")
+    if "has_valid_crossreg_eudract" not in data:
+        data = data.assign(has_valid_crossreg_eudract=None)
+    data["has_valid_crossreg_eudract"] = data["has_valid_crossreg_eudract"].fillna("FALSE")
+    return data.reset_index(drop=True)
+
+
+# Function to overwrite the rows of `data` matching the rows of `updates`
+# on the `by` columns with their other values, in place (like dplyr's
+# rows_update). Every row of `updates` has to match a trial.
+def update_rows(data, updates, by, what="updates"):
+    unknown = [column for column in updates.columns if column not in data.columns]
+    if unknown:
+        raise ValueError(f"{what} have columns the data does not: {', '.join(unknown)}")
+
+    positions = _positions(data)
+    columns = [column for column in updates.columns if column not in by]
+    for update in updates.to_dict("records"):
+        position = positions.get(update["id"])
+        if position is None or not all(_same(data.at[position, column], update[column])
+                                       for column in by):
+            key = ", ".join(str(update[column]) for column in by)
+            raise ValueError(f"{what} for a trial not in the data: {key}")
+        for column in columns:
+            data.at[position, column] = update[column]
+
+
+# Function to apply manual corrections, given as one (id, column, value)
+# row per corrected value, in place
+def correct(data, corrections):
+    positions = _positions(data)
+    for correction in corrections.to_dict("records"):
+        position = positions.get(correction["id"])
+        if position is None:
+            raise ValueError(f"correction for a trial not in the data: {correction['id']}")
+        if correction["column"] not in data.columns:
+            raise ValueError(f"correction of {correction['id']} for an unknown column: "
+                             f"{correction['column']}")
+        data.at[position, correction["column"]] = correction["value"]
+
+
+# Function to list the trials that are new or differ between two versions
+# of the assembled table
+def changed_trials(old, new):
+    if "id" not in old:
+        return list(new["id"])
+    old = old.set_index("id").reindex(columns=new.columns.drop("id"))
+    changed = []
+    for row in new.to_dict("records"):
+        trial = row.pop("id")
+        if trial not in old.index:
+            changed.append(trial)
+            continue
+        before = old.loc[trial]
+        if any(not _same(before[column], value) for column, value in row.items()):
+            changed.append(trial)
+    return changed
+
+
+# Function to write the assembled table as R's write_csv would
+def write_csv(data, path):
+    tmp = path + ".tmp"
+    data.to_csv(tmp, index=False, na_rep="NA")
+    os.replace(tmp, path)
+
+
+def _check_unique(data, what):
+    duplicated = data["id"][data["id"].duplicated()]
+    if len(duplicated):
+        raise ValueError(f"{what} list some trials more than once: {', '.join(sorted(set(duplicated)))}")
+
+
+def _positions(data):
+    return {trial: position for position, trial in zip(data.index, data["id"])}
+
+
+# Missing values are equal to each other here
+def _same(a, b):
+    if pd.isna(a) or pd.isna(b):
+        return pd.isna(a) and pd.isna(b)
+    return a == b
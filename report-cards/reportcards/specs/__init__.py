@@ -0,0 +1,5 @@
+from . import classic, merged
+
+
+# The kinds of report card, by name
+SPECS = {"classic": classic.SPEC, "merged": merged.SPEC}
@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+from ..fields import url_for_publication
+from ..render import CardSpec
+
+
+# The original report card (report-card.svg)
+
+
+def get_publication_title(row):
+    pub_title = (row['pub_title'])
+    if pd.isna(pub_title):
+        pub_title = "title not found (doi: " + row['doi'] + ")"
+    pub_title = pub_title.title()
+    cutoff = 50
+    if len(pub_title) > cutoff:
+        pub_title = pub_title[0:cutoff] + "…"
+    return pub_title
+
+
+def get_registry_name(row):
+    registry = row['registry']
+    if pd.isna(registry):
+        registry = "no registry information available"
+    return registry
+
+
+TABLE = {
+    "#open_access": {
+        "has_publication": {
+            False: {"layer": "open_access_layer_na"},
+            True: {
+                "is_oa": {
+                    True: {"layer": "open_access_layer_1"},
+                    np.NaN: {"layer": "open_access_layer_2"},
+                    False: {
+                        "is_closed_archivable": {
+                            True: {"layer": "open_access_layer_3"},
+                            False: {"layer": "open_access_layer_4"},
+                            np.NaN: {"layer": "open_access_layer_4"}
+                        }
+                    }
+                }
+            }
+        },
+    },
+    "#summary_results": {
+        "has_summary_results": {
+            False: {"layer": "summary_results_layer_1",
+                    "registry": {
+                        "id": "summary_results_1a_registry",
+                        "text": get_registry_name
+                    }},
+            True: {
+                "is_summary_results_1y": {
+                    True: {"layer": "summary_results_layer_2",
+                           "registry": {
+                               "id": "summary_results_2a_registry",
+                               "text": get_registry_name
+                           }},
+                    False: {"layer": "summary_results_layer_3",
+                            "registry": {
+                                "id": "summary_results_3a_registry",
+                                "text": get_registry_name,
+                            }}
+                }
+
+            }
+        }
+    },
+    "#publication": {
+        "has_publication": {
+            False: {"layer": "publication_layer_1"},
+            True: {
+                "is_publication_2y": {
+                    True: {"layer": "publication_layer_2",
+                           "link": {
+                               "id": "publication_2_link",
+                               "url": url_for_publication,
+                               "text": get_publication_title
+                           }},
+                    False: {"layer": "publication_layer_3",
+                            "link": {
+                                "id": "publication_3_link",
+                                "url": url_for_publication,
+                                "text": get_publication_title
+                            }}
+                }
+            }
+        }
+    },
+    "#linkage_full_text": {
+        "has_publication": {
+            False: {"layer": "linkage_layer_na"},
+            True: {
+                "has_iv_trn_ft": {
+                    True: {"layer": "linkage_layer_1"},
+                    False: {"layer": "linkage_layer_2"}}
+            }
+        }
+    },
+    "#linkage_abstract": {
+        "has_publication": {
+            False: {"layer": "linkage_layer_na"},
+            True: {
+                "has_iv_trn_abstract": {
+                    True: {"layer": "linkage_layer_3"},
+                    False: {"layer": "linkage_layer_4"}
+                }
+            }
+        }
+    },
+    "#linkage_registry": {
+        "has_publication": {
+            False: {"layer": "linkage_layer_na"},
+            True: {
+                "has_reg_pub_link": {
+                    True: {"layer": "linkage_layer_5"},
+                    False: {"layer": "linkage_layer_6"}
+                }
+            }
+        }
+    },
+    "#registration": {
+        "is_prospective": {
+            True: {"layer": "registration_layer_1",
+                   "registry": {
+                       "id": "registration_1_registry",
+                       "text": get_registry_name
+                   }},
+            False: {"layer": "registration_layer_2",
+                    "registry": {
+                        "id": "registration_2_registry",
+                        "text": get_registry_name
+                    }}
+        }
+    }
+}
+
+
+# Define layer characteristics in each module
+LAYERS = [{'name': 'registration', 'number': 2, 'na': False},
+          {'name': 'summary_results', 'number': 3, 'na': False},
+          {'name': 'publication', 'number': 3, 'na': False},
+          {'name': 'linkage', 'number': 6, 'na': True},
+          {'name': 'open_access', 'number': 4, 'na': True}]
+
+
+SPEC = CardSpec(TABLE, LAYERS, title_cutoff=80, trn_suffix="", field_type="text")
@@ -0,0 +1,291 @@
+import numpy as np
+import pandas as pd
+
+from ..fields import (gen_core_facility_email, get_completion_date, get_days_reg_to_start,
+                      get_euctr_trn, get_start_date, get_trn, url_for_euctr_crossreg,
+                      url_for_improve_link, url_for_improve_sumres, url_for_library,
+                      url_for_publication)
+from ..render import CardSpec, spacify
+
+
+# The merged report card (report-card-merged.svg)
+
+
+def get_publication_title(row):
+    citation = row['citation']
+    if pd.isna(citation):
+        citation = "DOI: " + row['doi']
+    cutoff = 50
+    if len(citation) > cutoff:
+        citation = citation[0:cutoff] + "…"
+    return citation
+
+
+def get_registry_name(row):
+    registry = row['registry']
+    if pd.isna(registry):
+        registry = "N/A"
+    return registry
+
+
+TABLE = {
+    "#open_access": {
+        "has_publication": {
+            False: {"layer": "open_access_layer_na"},
+            True: {
+                "is_oa": {
+                    True: {"layer": "open_access_layer_1"},
+                    np.NaN: {"layer": "open_access_layer_2"},
+                    False: {
+                        "is_closed_archivable": {
+                            True: {"layer": "open_access_layer_3",
+                                   "link_syp": {
+                                       "id": "open_access_improve_3a_syp",
+                                       "url": "https://shareyourpaper.org"
+                                   },
+                                   "link_library": {
+                                       "id": "open_access_improve_3a_library",
+                                       "url": url_for_library
+                                   }},
+                            False: {"layer": "open_access_layer_4"},
+                            np.NaN: {"layer": "open_access_layer_4"}
+                        }
+                    }
+                }
+            }
+        },
+    },
+    "#summary_results": {
+        "has_summary_results": {
+            False: {"layer": "summary_results_layer_1",
+                    "registry": {
+                        "id": "summary_results_registry_1a",
+                        "text": get_registry_name
+                    },
+                    "improve_registry": {
+                        "id": "summary_results_improve_registry_1a",
+                        "text": get_registry_name
+                    },
+                    "improve_sumres_link": {
+                        "id": "summary_results_improve_link_1a",
+                        "url": url_for_improve_sumres
+                    }},
+            True: {
+                "is_summary_results_1y": {
+                    False: {"layer": "summary_results_layer_2",
+                           "registry": {
+                               "id": "summary_results_registry_2a",
+                               "text": get_registry_name
+                           },
+                           "completion_date": {
+                               "id": "summary_results_completion_2b",
+                               "text": get_completion_date
+                           }},
+                    True: {"layer": "summary_results_layer_3",
+                            "registry": {
+                                "id": "summary_results_registry_3a",
+                                "text": get_registry_name,
+                            },
+                            "completion_date": {
+                                "id": "summary_results_completion_3b",
+                                "text": get_completion_date
+                            }}
+                }
+
+            }
+        }
+    },
+    "#publication": {
+        "has_publication": {
+            False: {"layer": "publication_layer_1"},
+            True: {
+                "is_publication_2y": {
+                    False: {"layer": "publication_layer_2",
+                           "link": {
+                               "id": "publication_link_2a",
+                               "url": url_for_publication,
+                               "text": get_publication_title
+                           },
+                           "completion_date": {
+                               "id": "publication_completion_date_2b",
+                               "text": get_completion_date
+                           }},
+                    True: {"layer": "publication_layer_3",
+                            "link": {
+                                "id": "publication_link_3a",
+                                "url": url_for_publication,
+                                "text": get_publication_title
+                            },
+                            "completion_date": {
+                                "id": "publication_completion_date_3b",
+                                "text": get_completion_date
+                            }}
+                }
+            }
+        }
+    },
+    "#linkage_abstract": {
+        "has_publication": {
+            False: {"layer": "linkage_layer_na"},
+            True: {
+                "has_iv_trn_abstract": {
+                    True: {"layer": "linkage_layer_1",
+                           "trn": {
+                               "id": "linkage_trn_1b",
+                               "text": get_trn,
+                               "post": spacify("linkage_text_1b")
+                           }},
+                    False: {"layer": "linkage_layer_2",
+                            "trn": {
+                                "id": "linkage_trn_2b",
+                                "text": get_trn,
+                                "post": spacify("linkage_text_2b")
+                            }}}
+            }
+        }
+    },
+    "#linkage_full_text": {
+        "has_publication": {
+            False: {"layer": "linkage_layer_na"},
+            True: {
+                "has_iv_trn_ft": {
+                    True: {"layer": "linkage_layer_3",
+                           "trn": {
+                               "id": "linkage_trn_3c",
+                               "text": get_trn,
+                               "post": spacify("linkage_text_3c")
+                           }},
+                    False: {"layer": "linkage_layer_4",
+                            "trn": {
+                                "id": "linkage_trn_4c",
+                                "text": get_trn,
+                                "post": spacify("linkage_text_4c")
+                            }}
+                }
+            }
+        }
+    },
+    "#linkage_registry": {
+        "has_publication": {
+            False: {"layer": "linkage_layer_na"},
+            True: {
+                "has_reg_pub_link": {
+                    True: {"layer": "linkage_layer_5"},
+                    False: {"layer": "linkage_layer_6",
+                            "registry": {
+                                "id": "linkage_improve_registry",
+                                "text": get_registry_name
+                            },
+                            "improve_linkage_link": {
+                                "id": "linkage_improve_link",
+                                "url": url_for_improve_link
+                            }}
+                }
+            }
+        }
+    },
+    "#registration": {
+        "is_prospective": {
+            True: {
+                "days_reg_to_start_is_positive": {
+                    True: {"layer": "registration_layer_1",
+                           "registry": {
+                               "id": "registration_registry_1",
+                               "text": get_registry_name
+                           },
+                           "start_date": {
+                               "id": "registration_start_date_1",
+                               "text": get_start_date
+                           }},
+                    False: {"layer": "registration_layer_2",
+                            "registry": {
+                                "id": "registration_registry_2",
+                                "text": get_registry_name
+                            },
+                            "start_date": {
+                                "id": "registration_start_date_2",
+                                "text": get_start_date
+                            }}
+                }
+            },
+            False: {"layer": "registration_layer_3",
+                    "registry": {
+                        "id": "registration_registry_3",
+                        "text": get_registry_name
+                    },
+                    "days_reg_to_start": {
+                        "id": "registration_days_3",
+                        "text": get_days_reg_to_start
+                    },
+                    "start_date": {
+                        "id": "registration_start_date_3",
+                        "text": get_start_date
+                    }},
+        }
+    },
+    "#euctr_crossreg": {
+        "has_valid_crossreg_eudract": {
+            False: {"layer": "euctr_crossreg_layer_na"},
+            True: {
+                "is_prospective_eudract": {
+                    True: {
+                        "has_summary_results_eudract": {
+                            True: {
+                                "layer": "euctr_crossreg_layer_1",
+                                "euctr_trn": {
+                                    "id": "euctr_crossreg_trn_1",
+                                    "text": get_euctr_trn,
+                                    "url": url_for_euctr_crossreg
+                                }},
+                            False: {
+                                "layer": "euctr_crossreg_layer_2",
+                                "euctr_trn": {
+                                    "id": "euctr_crossreg_trn_2",
+                                    "text": get_euctr_trn,
+                                    "url": url_for_euctr_crossreg
+                                },
+                                "improve_euctr_crossreg_link": {
+                                    "id": "euctr_crossreg_improve_link_2",
+                                    "email": gen_core_facility_email
+                                }},
+                        }
+                    },
+                    False: {
+                        "has_summary_results_eudract": {
+                            True: {
+                                "layer": "euctr_crossreg_layer_3",
+                                "euctr_trn": {
+                                    "id": "euctr_crossreg_trn_3",
+                                    "text": get_euctr_trn,
+                                    "url": url_for_euctr_crossreg
+                                }},
+                            False: {
+                                "layer": "euctr_crossreg_layer_4",
+                                "euctr_trn": {
+                                    "id": "euctr_crossreg_trn_4",
+                                    "text": get_euctr_trn,
+                                    "url": url_for_euctr_crossreg
+                                },
+                                "improve_euctr_crossreg_link": {
+                                    "id": "euctr_crossreg_improve_link_4",
+                                    "email": gen_core_facility_email
+                                }},
+                        }
+                    }
+                }
+            }
+        }
+    }
+}
+
+
+# Define layer characteristics in each module
+LAYERS = [{'name': 'registration', 'number': 3, 'na': False},
+          {'name': 'summary_results', 'number': 3, 'na': False},
+          {'name': 'publication', 'number': 3, 'na': False},
+          {'name': 'linkage', 'number': 6, 'na': True},
+          {'name': 'open_access', 'number': 4, 'na': True},
+          {'name': 'euctr_crossreg', 'number': 4, 'na': True}]
+
+
+SPEC = CardSpec(TABLE, LAYERS, title_cutoff=105, trn_suffix=":", field_type="g")
@@ -0,0 +1,159 @@
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+# Function to get the mode open() gives new files: 0666 less the umask.
+# Files written through mkstemp (readable by their owner only) are given it
+# before they are published, as stores are shared between users.
+def _file_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# Read once, as setting the umask to read it is not thread-safe
+FILE_MODE = _file_mode()
+
+
+class PdfStore:
+    """Content-addressed cache of converted PDFs.
+
+    PDFs are stored under the hash of the SVG they were converted from (and
+    the converter that did it), so an identical card is converted only once,
+    whatever run or output directory it is rendered for. Files are touched
+    when used and the least recently used ones are evicted once the store
+    grows beyond `max_bytes`. Hits and misses are added up in stats.json,
+    which all processes using the store share.
+    """
+
+    STATS_NAME = "stats.json"
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    # Function to compute the key of an SVG document (gzipped or not)
+    @staticmethod
+    def key(svg, converter_name):
+        if svg[:2] == b"\x1f\x8b":
+            svg = gzip.decompress(svg)
+        h = hashlib.sha256(converter_name.encode("utf-8") + b"\0")
+        h.update(svg)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.pdf")
+
+    # Function to look up a PDF; returns its path in the store or None
+    def get(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    # Function to add a PDF (a file or bytes) to the store
+    def put(self, key, pdf_path=None, pdf=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if pdf is None:
+                    with open(pdf_path, "rb") as src:
+                        shutil.copyfileobj(src, f)
+                else:
+                    f.write(pdf)
+            os.chmod(tmp, FILE_MODE)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    # Function to add this process's hits and misses to the shared stats
+    def flush_stats(self):
+        if not self.hits and not self.misses:
+            return
+        with self._locked_stats() as stats:
+            stats["hits"] += self.hits
+            stats["misses"] += self.misses
+        self.hits = self.misses = 0
+
+    def stats(self):
+        with self._locked_stats() as stats:
+            return dict(stats)
+
+    # Function to remove the least recently used PDFs until the store fits
+    # in max_bytes; returns the number of files removed
+    def evict(self):
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            for f in os.scandir(entry.path):
+                if f.name.endswith(".pdf"):
+                    st = f.stat()
+                    files.append((st.st_mtime, st.st_size, f.path))
+                    total += st.st_size
+
+        removed = 0
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            removed += 1
+
+        if removed:
+            with self._locked_stats() as stats:
+                stats["evictions"] += removed
+        return removed
+
+    def _locked_stats(self):
+        return _LockedJSON(os.path.join(self.directory, self.STATS_NAME),
+                           {"hits": 0, "misses": 0, "evictions": 0})
+
+
+class _LockedJSON:
+    """Read-modify-write of a small JSON file under an exclusive lock."""
+
+    def __init__(self, path, default):
+        self.path = path
+        self.default = default
+
+    def __enter__(self):
+        self.lock = open(self.path + ".lock", "w")
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        self.data = dict(self.default)
+        try:
+            with open(self.path) as f:
+                self.data.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return self.data
+
+    def __exit__(self, exc_type, *exc):
+        try:
+            if exc_type is None:
+                tmp = self.path + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(self.data, f, indent=1)
+                os.replace(tmp, self.path)
+        finally:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
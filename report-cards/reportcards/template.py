@@ -0,0 +1,255 @@
+import collections
+import copy
+import hashlib
+import json
+import os
+
+from lxml import etree
+
+from .journal import partial_path
+
+
+SVG_NS = "http://www.w3.org/2000/svg"
+XLINK_NS = "http://www.w3.org/1999/xlink"
+
+# Bump when the layout of the cached index changes
+INDEX_VERSION = 1
+
+# How cards can be written out, and the extension of the files
+SVG_FORMATS = {"pretty": ".svg", "compact": ".svg", "svgz": ".svgz"}
+
+
+# Function to walk the tree once and record where every id lives.
+# The path is the list of child positions from the root, so it can be
+# replayed on any copy of the tree without searching.
+def build_index(root):
+    index = {}
+    stack = [(root, ())]
+    while stack:
+        node, path = stack.pop()
+        for i, child in enumerate(node):
+            if not isinstance(child.tag, str):
+                continue  # comments and processing instructions
+            child_path = path + (i,)
+            qname = etree.QName(child)
+            child_id = child.get("id")
+            # Keep the first match in document order, like the xpath did
+            if child_id is not None and qname.namespace == SVG_NS:
+                if child_id not in index or child_path < index[child_id][1]:
+                    index[child_id] = (qname.localname, child_path)
+            stack.append((child, child_path))
+    return index
+
+
+class CompiledTemplate:
+    """An SVG template parsed once, with an id -> path index of its elements.
+
+    The pruned copies of the template (see variant) are kept for the
+    `max_variants` combinations of layers used most recently, as each takes
+    about as much memory as the template itself.
+    """
+
+    # About 20 MB; a few combinations cover most cards, the rarer ones are
+    # pruned again when needed (which takes a few milliseconds)
+    MAX_VARIANTS = 64
+
+    def __init__(self, root, index, digest, max_variants=MAX_VARIANTS):
+        self.root = root
+        self.index = index
+        self.digest = digest
+        # Pruned copies of the template per combination of excluded layers
+        self._variants = collections.OrderedDict()
+        self.max_variants = max_variants
+        self.variant_hits = 0
+        self.variant_misses = 0
+
+    # With an AssetStore (see assets.py), the embedded images are moved
+    # out of the template into the store and the cards only refer to them
+    @classmethod
+    def load(cls, path, cache_dir=None, assets=None):
+        with open(path, "rb") as f:
+            data = f.read()
+        return cls.from_bytes(data, cache_dir=cache_dir, assets=assets)
+
+    @classmethod
+    def from_bytes(cls, data, cache_dir=None, assets=None):
+        digest = hashlib.sha256(data).hexdigest()
+        root = etree.fromstring(data)
+
+        index = None
+        cache_file = None
+        if cache_dir:
+            cache_file = os.path.join(cache_dir, f"{digest}.index.json")
+            index = _read_index(cache_file)
+
+        if index is None:
+            index = build_index(root)
+            if cache_file:
+                _write_index(cache_file, index)
+
+        # Only attributes change, so the index still holds
+        if assets is not None and assets.externalize(root):
+            digest = hashlib.sha256(f"{digest}:{assets.directory}".encode("utf-8")).hexdigest()
+
+        return cls(root, index, digest)
+
+    def has(self, id_name, section_type=None):
+        entry = self.index.get(id_name)
+        if entry is None:
+            return False
+        return section_type is None or entry[0] == section_type
+
+    # The template without the elements listed in `exclude` (ids of groups),
+    # as (root, index, pruned ids). Cards only differ in which layers they
+    # keep, so each combination is pruned and indexed once and then reused.
+    def variant(self, exclude=()):
+        pruned = {}
+        for id_name in exclude:
+            entry = self.index.get(id_name)
+            if entry is not None and entry[0] == "g":
+                pruned[entry[1]] = id_name
+
+        key = frozenset(pruned.values())
+        variant = self._variants.get(key)
+        if variant is not None:
+            self._variants.move_to_end(key)
+            self.variant_hits += 1
+            return variant
+        self.variant_misses += 1
+
+        # Nothing below an excluded element needs to be excluded separately
+        cut = {path for path in pruned
+               if not any(path[:depth] in pruned for depth in range(1, len(path)))}
+        if cut:
+            through = {path[:depth] for path in cut for depth in range(len(path))}
+            root = _copy_pruned(self.root, (), cut, through)
+            variant = (root, build_index(root), key)
+        else:
+            variant = (self.root, self.index, key)
+        self._variants[key] = variant
+        while len(self._variants) > self.max_variants:
+            self._variants.popitem(last=False)
+        return variant
+
+    # Fresh, independent copy of the template to render one card into,
+    # leaving out the layers in `exclude` (see variant)
+    def instantiate(self, exclude=()):
+        root, index, pruned = self.variant(exclude)
+        return Card(self, copy.deepcopy(root), index, pruned)
+
+
+class Card:
+    """A copy of a template being filled in for one trial.
+
+    Elements are looked up through the index of the variant the card was
+    copied from and memoized, so lookups stay valid while the card is
+    edited (e.g. text wrapped into links) as long as layers are only
+    removed at the end.
+    """
+
+    def __init__(self, template, root, index=None, pruned=()):
+        self.template = template
+        self.root = root
+        self.index = template.index if index is None else index
+        # Ids left out when the card was instantiated
+        self.pruned = pruned
+        self._resolved = {}
+        # Number of index lookups, for profiling
+        self.lookups = 0
+
+    def find(self, id_name, section_type="g"):
+        self.lookups += 1
+        node = self._resolved.get(id_name)
+        if node is not None:
+            return node if etree.QName(node).localname == section_type else None
+
+        entry = self.index.get(id_name)
+        if entry is None or entry[0] != section_type:
+            return None
+
+        node = self.root
+        for i in entry[1]:
+            node = node[i]
+        self._resolved[id_name] = node
+        return node
+
+    # Remove several layers; all are located before anything is detached
+    def remove(self, ids, section_type="g"):
+        nodes = []
+        for id_name in ids:
+            if id_name in self.pruned and section_type == "g":
+                continue  # never copied in the first place
+            node = self.find(id_name, section_type)
+            if node is None:
+                raise Exception(f"{id_name} field does not exist")
+            nodes.append(node)
+
+        for node in nodes:
+            parent = node.getparent()
+            if parent is not None:
+                parent.remove(node)
+
+
+# Function to copy `node` (into `parent`) without the elements at the paths
+# in `cut`. Only the elements in `through` (ancestors of a cut) are copied
+# one by one, every other child is deep-copied in one go.
+def _copy_pruned(node, path, cut, through, parent=None):
+    if parent is None:
+        copied = etree.Element(node.tag, node.attrib, nsmap=node.nsmap)
+    else:
+        copied = etree.SubElement(parent, node.tag, node.attrib)
+    copied.text = node.text
+    copied.tail = node.tail
+    for i, child in enumerate(node):
+        child_path = path + (i,)
+        if child_path in cut:
+            continue
+        if child_path in through:
+            _copy_pruned(child, child_path, cut, through, copied)
+        else:
+            copied.append(copy.deepcopy(child))
+    return copied
+
+
+# Function to serialize a card to bytes for use in memory: pretty printed,
+# or compact (which is also what svgz holds once unpacked)
+def serialize(root, svg_format="pretty"):
+    return etree.tostring(root, pretty_print=svg_format == "pretty", encoding="utf-8")
+
+
+# Function to write a card straight to a file in one of SVG_FORMATS;
+# libxml2 streams the tree to the file (gzipped for svgz) without building
+# the whole document in memory first
+def write_svg(root, path, svg_format="pretty"):
+    # Written next to the card and renamed into place, so that a card is
+    # never left half-written
+    tmp = partial_path(path)
+    try:
+        etree.ElementTree(root).write(tmp, pretty_print=svg_format == "pretty", encoding="utf-8",
+                                      compression=9 if svg_format == "svgz" else 0)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _read_index(cache_file):
+    try:
+        with open(cache_file, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("version") != INDEX_VERSION:
+        return None
+    return {k: (v[0], tuple(v[1])) for k, v in cached["index"].items()}
+
+
+def _write_index(cache_file, index):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp = cache_file + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"version": INDEX_VERSION,
+                   "index": {k: [v[0], list(v[1])] for k, v in index.items()}}, f)
+    os.replace(tmp, cache_file)
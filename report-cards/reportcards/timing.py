@@ -0,0 +1,51 @@
+import collections
+import contextlib
+import time
+
+
+class StageTimer:
+    """Accumulates wall-clock time and call counts per named stage, plus
+    counters of events (e.g. element lookups)."""
+
+    def __init__(self):
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.Counter()
+        self.events = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[name] += time.perf_counter() - start
+            self.counts[name] += 1
+
+    # Function to add time measured elsewhere to a stage, e.g. of work that
+    # finished in the background
+    def add(self, name, seconds):
+        self.totals[name] += seconds
+        self.counts[name] += 1
+
+    def count(self, name, n=1):
+        self.events[name] += n
+
+    def as_dict(self):
+        return {name: {"seconds": self.totals[name], "calls": self.counts[name]}
+                for name in self.totals}
+
+
+class NullTimer:
+    """Stands in for StageTimer when nothing is measured."""
+
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+
+NULL_TIMER = NullTimer()
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+import argparse
+import sys
+
+from reportcards import converters
+from reportcards.converters import CachingConverter
+from reportcards.service import CardService, make_server
+from reportcards.specs import merged
+from reportcards.store import PdfStore
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve report cards on demand: GET /cards/<TRN>.svg (or .svgz, .pdf) and /status')
+    parser.add_argument('template', metavar='TEMPLATE', type=str,
+                        help='The template to use')
+    parser.add_argument('data', metavar='DATA', type=str,
+                        help='The data to use (.csv file); reloaded when it changes')
+    parser.add_argument('--host', metavar='HOST', type=str, default="127.0.0.1",
+                        help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', metavar='PORT', type=int, default=8000,
+                        help='Port to listen on (default: 8000)')
+    parser.add_argument('--socket', metavar='PATH', type=str,
+                        help='Listen on this Unix socket instead of a TCP port')
+    parser.add_argument('--converter', choices=sorted(converters.CONVERTERS),
+                        help='How to convert SVG to PDF; without it only SVG cards are served')
+    parser.add_argument('--inkscape', metavar='PATH', type=str,
+                        help='The Inkscape binary (default: $INKSCAPE, the PATH or the usual install locations)')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=120,
+                        help='Kill a conversion that takes longer than this (default: 120)')
+    parser.add_argument('--retries', metavar='N', type=int, default=1,
+                        help='Times a failed or killed conversion is retried (default: 1)')
+    parser.add_argument('--cache-dir', metavar='DIR', type=str,
+                        help='Where to keep the compiled template index (and a Parquet copy of the data)')
+    parser.add_argument('--pdf-cache', metavar='DIR', type=str,
+                        help='Keep converted PDFs in this directory, keyed by the content of the SVG')
+    parser.add_argument('--cached-cards', metavar='N', type=int, default=1024,
+                        help='Number of rendered cards kept in memory (default: 1024)')
+
+    args = parser.parse_args()
+
+    converter = None
+    if args.converter:
+        try:
+            converter = converters.get_converter(args.converter, args.inkscape, args.timeout, args.retries)
+        except (FileNotFoundError, converters.ConversionError) as e:
+            parser.error(str(e))
+        if args.pdf_cache:
+            converter = CachingConverter(converter, PdfStore(args.pdf_cache), args.converter)
+
+    service = CardService(merged.SPEC, args.template, args.data, converter,
+                          cache_dir=args.cache_dir, max_cached=args.cached_cards)
+    server = make_server(service, args.host, args.port, args.socket)
+    where = args.socket or f"http://{args.host}:{server.server_port}"
+    print(f"Serving {len(service.trials)} report cards on {where}", file=sys.stderr)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()